@@ -153,9 +153,16 @@ def initialize_nodes_startup():
         
         _nodes_initialized = True
         
-        # 초기화 완료 상태 저장
+        # RAG는 백그라운드에서 준비되므로, 준비가 끝난 뒤에만 초기화 완료 상태 저장
+        threading.Thread(target=_mark_initialized_when_rag_ready, name="rag-ready-marker", daemon=True).start()
+        print("✅ 노드 초기화 완료! RAG 준비가 끝나면 다음 재시작부터는 빠르게 시작됩니다.")
+
+def _mark_initialized_when_rag_ready():
+    """RAG 시스템 준비 완료 후 초기화 상태 저장 (실패 시 저장하지 않음)"""
+    if rag_diagnosis_node.wait_until_ready():
         mark_initialization_complete()
-        print("✅ 최초 전체 초기화 완료! 다음 재시작부터는 빠르게 시작됩니다.")
+    else:
+        print("⚠️ RAG 시스템 초기화 실패 - 초기화 상태를 저장하지 않습니다.")
 
 def initialize_nodes_once():
     """API 요청시 노드 초기화 확인 (Fallback)"""
@@ -321,7 +328,8 @@ def run_langgraph_pipeline_with_progress(diagnosis_id: str, request: DiagnosisRe
             "height_cm": float(request.userInfo.height),
             "gender": request.userInfo.gender,
             "session_id": diagnosis_id,
-            "timestamp": request.timestamp
+            "timestamp": request.timestamp,
+            "start_time": datetime.now()  # FormatResponseNode가 처리 시간을 계산하는 기준
         })
         
         current_state = initial_state.copy()
@@ -884,10 +892,21 @@ async def get_diagnosis_status(diagnosis_id: str):
     
     return DiagnosisResponse(success=True, data=response_data)
 
+@app.on_event("shutdown")
+def flush_pending_diagnoses():
+    """종료 전 대기 중인 진단 저장 요청을 모두 기록"""
+    if store_diagnosis_node is not None:
+        store_diagnosis_node.close()
+
 @app.get("/api/v1/health")
 async def health_check():
     """헬스 체크 엔드포인트"""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    # status는 기존 liveness 체크와 호환되도록 유지, RAG 준비 여부는 rag_ready로만 노출
+    return {
+        "status": "healthy",
+        "rag_ready": rag_diagnosis_node is not None and rag_diagnosis_node.is_ready,
+        "timestamp": datetime.now().isoformat()
+    }
 
 @app.get("/api/v1/pipeline-info")
 async def pipeline_info():
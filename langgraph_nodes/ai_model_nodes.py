@@ -81,7 +81,7 @@ class PredictPhasesNode(BaseNode):
             filtered_path = Path(filtered_csv_path)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             labels_filename = f"support_labels_{filtered_path.stem}_{timestamp}.csv"
-            temp_dir = Path(os.getenv('TEMP_DIR', './temp_files'))
+            temp_dir = self.get_session_temp_dir(session_id)
             labels_path = temp_dir / labels_filename
             
             # Run Stage-2 prediction
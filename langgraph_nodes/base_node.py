@@ -5,6 +5,7 @@ All nodes inherit from BaseNode which provides LLM integration
 import time
 import logging
 from abc import ABC, abstractmethod
+from pathlib import Path
 from typing import Dict, Any, Optional
 
 from langchain_openai import ChatOpenAI
@@ -22,6 +23,21 @@ load_dotenv()
 logging.basicConfig(level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO')))
 logger = logging.getLogger(__name__)
 
+
+def resolve_session_temp_dir(session_id: Optional[str]) -> Optional[Path]:
+    """
+    Per-session temporary directory TEMP_DIR/<session_id>
+    
+    Returns None when session_id is missing, "unknown", or not a single path
+    component, so sessions without an id never share (or escape) a directory.
+    """
+    if not isinstance(session_id, str) or session_id in ("", "unknown", ".", ".."):
+        return None
+    if Path(session_id).name != session_id or (os.altsep and os.altsep in session_id):
+        return None
+    
+    return Path(os.getenv('TEMP_DIR', './temp_files')) / session_id
+
 class LLMManager:
     """Manages LLM instances and common operations"""
     
@@ -196,6 +212,18 @@ class BaseNode(ABC):
         
         return prompt
     
+    def get_session_temp_dir(self, session_id: str) -> Path:
+        """
+        Per-session temporary directory (TEMP_DIR/<session_id>), created on demand
+        Cleanup removes the whole directory instead of scanning TEMP_DIR by filename
+        """
+        session_dir = resolve_session_temp_dir(session_id)
+        if session_dir is None:
+            raise ValueError(f"Invalid session_id for temporary files: {session_id!r}")
+        
+        session_dir.mkdir(parents=True, exist_ok=True)
+        return session_dir
+    
     def validate_state_requirements(self, state: GraphState, required_fields: list) -> bool:
         """
         Validate that required fields are present in state
@@ -235,12 +235,9 @@ class DownloadCsvNode(BaseNode):
             # Generate local filename
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             local_filename = f"downloaded_{user_id}_{timestamp}_{file_name}"
-            temp_dir = Path(os.getenv('TEMP_DIR', './temp_files'))
+            temp_dir = self.get_session_temp_dir(session_id)
             local_path = temp_dir / local_filename
             
-            # Ensure temp directory exists
-            temp_dir.mkdir(exist_ok=True)
-            
             # Save downloaded content to local file
             with open(local_path, 'wb') as f:
                 f.write(response)
@@ -372,7 +369,7 @@ class FilterDataNode(BaseNode):
             raw_path = Path(raw_csv_path)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             trimmed_filename = f"trimmed_{raw_path.stem}_{timestamp}.csv"
-            temp_dir = Path(os.getenv('TEMP_DIR', './temp_files'))
+            temp_dir = self.get_session_temp_dir(session_id)
             trimmed_path = temp_dir / trimmed_filename
             
             df_trimmed.to_csv(trimmed_path, index=False)
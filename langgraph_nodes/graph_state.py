@@ -52,6 +52,7 @@ class GraphState(TypedDict):
     error_type: Optional[str]
     
     # Metadata
+    start_time: Optional[datetime]  # Pipeline start, kept as datetime to avoid re-parsing
     processing_time: Optional[float]
     iterations: Optional[int]
 
@@ -63,10 +64,12 @@ class StateManager:
         """Create initial GraphState from request parameters"""
         if date is None:
             date = datetime.now().strftime("%Y-%m-%d")
+        
+        start_time = datetime.now()
             
         return GraphState(
             session_id=str(uuid.uuid4()),
-            timestamp=datetime.now().isoformat(),
+            timestamp=start_time.isoformat(),
             stage="initialized",
             user_id=user_id,
             date=date,
@@ -88,6 +91,7 @@ class StateManager:
             response=None,
             error=None,
             error_type=None,
+            start_time=start_time,
             processing_time=0.0,
             iterations=0
         )
@@ -4,21 +4,39 @@ Implements 3 nodes: compose_prompt, rag_diagnosis, store_diagnosis
 Uses PDF documents for medical knowledge retrieval
 """
 import os
+import re
+import logging
 import json
+import shutil
+import time
+import queue
+import functools
+import hashlib
+import threading
 import pandas as pd
 from pathlib import Path
+from types import MappingProxyType
 from datetime import datetime
-from typing import Dict, Any, Optional, List
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 # RAG and Vector Database imports
 import chromadb
 from langchain_chroma import Chroma
 from langchain_community.document_loaders import PyPDFLoader, DirectoryLoader
-from langchain_community.embeddings import HuggingFaceEmbeddings
+try:
+    from langchain_huggingface import HuggingFaceEmbeddings
+except ImportError:
+    # Deprecated community wrapper, kept for environments without the partner package
+    from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
+from transformers import AutoTokenizer
+from supabase import create_client, Client, ClientOptions
+from postgrest.exceptions import APIError
 
-import os
 from dotenv import load_dotenv
 
 # Conditional imports to handle both module and script execution
@@ -49,6 +67,441 @@ except ImportError:
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Diagnosis storage (Service Role key bypasses RLS policies)
+SUPABASE_URL = os.getenv('SUPABASE_URL')
+SUPABASE_SERVICE_ROLE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
+AI_MODEL_NAME = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+BULK_INSERT_CHUNK_SIZE = 500
+SUPABASE_POSTGREST_TIMEOUT = float(os.getenv('SUPABASE_POSTGREST_TIMEOUT', '10'))
+DIAGNOSIS_INSERT_MAX_ROWS = int(os.getenv('DIAGNOSIS_INSERT_MAX_ROWS', '100'))
+DIAGNOSIS_INSERT_WAIT_MS = float(os.getenv('DIAGNOSIS_INSERT_WAIT_MS', '25'))
+# true: execute() queues the row and returns without waiting for the record id
+DIAGNOSIS_INSERT_ASYNC = os.getenv('DIAGNOSIS_INSERT_ASYNC', 'false').lower() == 'true'
+DIAGNOSIS_INSERT_TIMEOUT_SECONDS = float(os.getenv('DIAGNOSIS_INSERT_TIMEOUT', '30'))
+
+# Embedding configuration
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_BATCH_SIZE = int(os.getenv('RAG_EMBEDDING_BATCH_SIZE', '128'))
+EMBEDDING_BACKEND = os.getenv('RAG_EMBEDDING_BACKEND', 'torch').lower()  # torch | onnx
+EMBEDDING_ONNX_FILE = os.getenv('RAG_EMBEDDING_ONNX_FILE', 'onnx/model_quint8_avx2.onnx')
+EMBEDDING_DEVICE = os.getenv('RAG_EMBEDDING_DEVICE', 'cpu')  # torch backend: cpu | cuda | mps
+INGEST_BATCH_SIZE = int(os.getenv('RAG_INGEST_BATCH_SIZE', '128'))  # Chroma writes are fastest in 100-250 row batches
+PDF_MANIFEST_FILENAME = "pdf_manifest.json"
+INGEST_SENTINEL_FILENAME = ".ingested"
+
+# Longest execute() waits for background RAG initialization before failing the request
+RAG_INIT_TIMEOUT_SECONDS = float(os.getenv('RAG_INIT_TIMEOUT', '300'))
+
+RETRIEVAL_TOP_K = 4
+RETRIEVED_SNIPPET_LENGTH = 300
+
+# Static diagnosis instructions, sent as the system prompt so the LLM provider can
+# reuse the cached prefix across requests
+RAG_DIAGNOSIS_SYSTEM_PROMPT = """당신은 임상 보행 분석 전문의입니다. 사용자가 제공하는 검색된 의료 문헌 정보를 바탕으로 환자를 진단하고 구조화된 평가를 제공하세요.
+
+=== 진단 지침 ===
+1. **오직 검색된 의료 문헌의 기준과 정보만 사용**하여 진단하세요
+2. 진단 근거를 제시할 때 **구체적인 문헌명과 내용을 인용**하세요
+3. 각 판단마다 **"참조문헌 X에 따르면..."** 형식으로 출처를 명시하세요
+4. 검색된 정보에 근거가 없으면 "추가 정보 필요"라고 명시하세요
+5. 최종 평가는 정확한 점수(0-100)와 상태를 포함하세요
+
+=== 응답 형식 (정확히 이 형식으로만 응답) ===
+CLINICAL_ASSESSMENT: [정상/주의/위험 중 하나]
+SCORE: [0-100 사이의 정수]
+STATUS: [구체적인 상태 설명]
+RISK_LEVEL: [정상 단계/주의 단계/위험 단계 중 하나]
+
+임상 평가: [검색된 문헌 기준으로 상세 판정]
+
+주요 소견: [검색된 문헌에서 찾은 관련 패턴과 환자 데이터 비교]
+
+문헌 근거: 
+- 참조문헌 1 ([파일명]): [구체적 인용 내용]
+- 참조문헌 2 ([파일명]): [구체적 인용 내용]
+- (검색된 참조문헌마다 한 줄씩)
+
+신뢰도: [검색된 정보의 충분성과 일치성에 따른 신뢰도]
+
+진단: [검색된 문헌에 기반한 가능성 높은 진단명]
+
+권장사항: [검색된 문헌에서 제시된 치료/관리 방안]
+
+참고문헌 목록:
+[제공된 참고문헌 목록을 그대로 나열]
+
+**중요: 응답 시작 부분의 CLINICAL_ASSESSMENT, SCORE, STATUS, RISK_LEVEL을 반드시 포함하고, 모든 판단은 검색된 의료 문헌 정보에만 근거하세요.**"""
+
+# Per-request part of the diagnosis prompt
+RAG_DIAGNOSIS_USER_TEMPLATE = """=== 검색된 의료 문헌 정보 ===
+{retrieved_knowledge}
+
+=== 환자 보행 분석 데이터 ===
+{patient_data}
+
+=== 참고문헌 목록 ===
+{reference_list}"""
+
+# Structured fields the diagnosis LLM is asked to emit, one per line
+ASSESSMENT_FIELD_PATTERN = re.compile(
+    r'^[ \t]*(CLINICAL_ASSESSMENT|SCORE|STATUS|RISK_LEVEL):(.*)$',
+    re.MULTILINE
+)
+# Leading number of a SCORE value (e.g. "85", ": 85점"), at most three digits
+SCORE_VALUE_PATTERN = re.compile(r'^\s*[:：]?\s*(\d{1,3})(?!\d)')
+REPORT_TITLE_LINE_PATTERN = re.compile(r'^.*(?:진단|임상 평가):.*$', re.MULTILINE)
+
+# One retrieved reference as shown to the LLM
+RETRIEVED_DOCUMENT_TEMPLATE = """
+=== 참조문헌 {index}: {source_file} ===
+문서유형: {doc_type}
+페이지: {page_num}
+관련내용:
+{content}
+
+"""
+
+# HNSW index parameters for the medical knowledge collection
+HNSW_COLLECTION_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:construction_ef": 200,
+    "hnsw:M": 32,
+    "hnsw:search_ef": 64
+}
+VECTOR_INDEX_WARMUP_QUERY = "보행 분석 정상 보행 속도"
+
+# Token-aware chunking (measured with the embedding model's tokenizer)
+CHUNK_SIZE_TOKENS = 200
+CHUNK_OVERLAP_TOKENS = 20
+CHUNK_MERGE_MIN_TOKENS = 100
+CHUNK_MERGE_MAX_TOKENS = 220
+
+# detailedReport title when the LLM reply has no "진단:" / "임상 평가:" line
+DETAILED_REPORT_DEFAULT_TITLE = "의료 진단 결과"
+
+# Static detailedReport blocks for failure paths (copied per response)
+DETAILED_REPORT_EXTRACTION_ERROR = MappingProxyType({
+    "title": "진단 결과",
+    "content": "진단 결과를 처리하는 중 오류가 발생했습니다."
+})
+DETAILED_REPORT_GENERATION_ERROR = MappingProxyType({
+    "title": "진단 오류",
+    "content": "분석 중 오류가 발생했습니다. 다시 시도해 주세요."
+})
+
+# Indicator status -> result message shown with each indicator
+INDICATOR_RESULTS = {
+    "normal": "분석 결과 정상입니다!",
+    "warning": "분석 결과 주의입니다!",
+    "danger": "분석 결과 위험입니다!"
+}
+
+# (id, name, metric key, default, scale, value formatter, description, status rule) per indicator;
+# status rules take the scaled value (double support in %, asymmetry in %)
+INDICATOR_SPECS = (
+    ("stride-time", "보폭 시간", "avg_stride_time", 1.1, 1, "{:.2f}초".format,
+     "한쪽 발이 땅에 닿은 후, 같은 발이 다시 닿을 때까지 걸리는 시간입니다. 걸음 템포를 확인할 수 있어요.",
+     lambda v: "normal" if 1.0 <= v <= 1.2 else "warning" if 0.8 <= v <= 1.4 else "danger"),
+    ("double-support", "양발 지지 비율", "double_support_ratio", 0.2, 100, "{:.1f}%".format,
+     "두 발이 동시에 땅에 닿아 있는 시간의 비율이에요. 보행 균형이 불안할수록 높아집니다.",
+     lambda v: "normal" if v < 25.0 else "warning" if 25.0 <= v <= 30.0 else "danger"),
+    ("stride-difference", "양발 보폭 차이", "stride_length_asymmetry", 0.0, 1, "{:.2f}m".format,
+     "왼발과 오른발의 걸음 길이가 얼마나 다른지를 보여줍니다. 좌우 균형 상태를 파악할 수 있어요.",
+     lambda v: "normal" if v < 3.0 else "warning" if 3.0 <= v <= 7.0 else "danger"),
+    ("walking-speed", "평균 보행 속도", "avg_walking_speed", 1.2, 1, "{:.1f}m/s".format,
+     "단위 시간 동안 이동한 거리를 나타내는 지표입니다. 전체 활동성과 운동 능력을 확인할 수 있어요.",
+     lambda v: "normal" if v > 1.2 else "warning" if 0.9 <= v <= 1.2 else "danger"),
+    ("stance-phase", "입각기 비율", "stance_phase_ratio", 0.6, 1, "{:.1%}".format,
+     "보행 주기 중 발이 땅에 닿아 있는 시간의 비율입니다. 균형과 안정성을 평가할 수 있어요.",
+     lambda v: "normal" if 0.5 <= v <= 0.7 else "warning" if 0.3 <= v <= 1.0 else "danger"),
+)
+
+# Opt-in exact diagnosis memo keyed by model + composed prompt (0 entries also disables)
+DIAGNOSIS_MEMO_ENABLED = os.getenv('RAG_DIAGNOSIS_MEMO', 'false').lower() == 'true'
+DIAGNOSIS_MEMO_MAX_ENTRIES = int(os.getenv('RAG_DIAGNOSIS_MEMO_SIZE', '512'))
+DIAGNOSIS_MEMO_TTL_SECONDS = float(os.getenv('RAG_DIAGNOSIS_MEMO_TTL', '3600'))
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv('RAG_EMBED_CACHE_SIZE', '2048'))
+EMBED_CACHE_TTL_SECONDS = float(os.getenv('RAG_EMBED_CACHE_TTL', '3600'))
+
+# Defaults for the 15 prompt metrics when a metric is missing from gait_metrics
+PROMPT_METRIC_DEFAULTS = MappingProxyType({
+    'avg_stride_time': 0,
+    'avg_stride_length': 0,
+    'avg_walking_speed': 0,
+    'cadence': 0,
+    'stride_time_asymmetry': 0,
+    'stride_length_asymmetry': 0,
+    'stride_time_cv': 0,
+    'walking_speed_cv': 0,
+    'stride_length_cv': 0,
+    'step_width': 0,
+    'gait_regularity_index': 0,
+    'gait_stability_ratio': 0,
+    'stance_phase_ratio': 0.6,
+    'swing_phase_ratio': 0.4,
+    'double_support_ratio': 0.2
+})
+
+# Diagnostic prompt covering all 15 gait metrics (filled by ComposePromptNode)
+DIAGNOSTIC_PROMPT_TEMPLATE = """보행 분석 결과
+
+환자 정보: 신장 {height_cm}cm, 날짜 {date}
+
+전체 15개 객관적 지표:
+
+【시간적 지표】
+• 보폭 시간: {avg_stride_time:.2f}초 (정상: 1.0-1.3초)
+• 보행률: {cadence:.0f}걸음/분 (정상: 100-120)
+• 보폭 시간 변동성: {stride_time_cv:.1f}% (정상: <5%)
+
+【공간적 지표】
+• 보폭 길이: {avg_stride_length:.2f}m (정상: 1.2-1.6m)
+• 보폭 길이 변동성: {stride_length_cv:.1f}% (정상: <5%)
+• 보폭 폭: {step_width:.2f}m (정상: 0.1-0.15m)
+
+【속도 지표】
+• 보행 속도: {avg_walking_speed:.2f}m/s (정상: 1.0-1.4m/s)
+• 보행 속도 변동성: {walking_speed_cv:.1f}% (정상: <5%)
+
+【비대칭성 지표】
+• 보폭 시간 비대칭성: {stride_time_asymmetry:.1f}% (정상: <5%)
+• 보폭 길이 비대칭성: {stride_length_asymmetry:.1f}% (정상: <5%)
+
+【안정성 지표】
+• 보행 규칙성 지수: {gait_regularity_index:.3f} (정상: >0.8)
+• 보행 안정성 비율: {gait_stability_ratio:.3f} (정상: >0.8)
+
+【보행 주기 지표】
+• 입각기 비율: {stance_phase_ratio:.1%} (정상: 60-65%)
+• 유각기 비율: {swing_phase_ratio:.1%} (정상: 35-40%)
+• 양발지지 비율: {double_support_ratio:.1%} (정상: 15-25%)
+
+임상 질문: 이 15개 모든 지표를 종합적으로 분석하여 가장 가능성이 높은 임상 평가는 무엇입니까? 정상 대 병리학적 패턴만 고려하세요."""
+
+_supabase_client: Optional[Client] = None
+_supabase_lock = threading.Lock()
+
+
+def _get_supabase() -> Client:
+    """Process-wide Supabase client so diagnosis stores reuse one connection pool"""
+    global _supabase_client
+    
+    if _supabase_client is None:
+        with _supabase_lock:
+            if _supabase_client is None:
+                if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
+                    raise ValueError("Supabase credentials not found in environment variables")
+                
+                options = ClientOptions(postgrest_client_timeout=SUPABASE_POSTGREST_TIMEOUT, schema="public")
+                _supabase_client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, options=options)
+    
+    return _supabase_client
+
+
+class DiagnosisInsertBatcher:
+    """
+    Coalesce concurrent row inserts into one Supabase array insert
+    
+    Rows queued within max_wait_ms of each other (up to max_batch) share a
+    single round-trip; each caller gets a Future resolving to its stored record.
+    A batch PostgREST rejects (APIError, rolled back) is retried row by row so one
+    bad row only fails its own Future. Timeouts and transport errors are not
+    retried: the batch may already be committed, and a retry would duplicate it.
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, table: str, max_batch: int = 32, max_wait_ms: float = 25):
+        self.table = table
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+        self._closed = False
+    
+    def submit(self, row: Dict[str, Any]) -> Future:
+        """Queue a row for insertion; the Future yields the inserted record or None"""
+        future = Future()
+        
+        with self._worker_lock:
+            if not self._closed:
+                if self._worker is None:
+                    self._worker = threading.Thread(
+                        target=self._run, name=f"{self.table}-insert-batcher", daemon=True
+                    )
+                    self._worker.start()
+                self._queue.put((row, future))
+                return future
+        
+        # After close() rows are written synchronously
+        self._flush([(row, future)])
+        return future
+    
+    def close(self, timeout: Optional[float] = 10.0):
+        """Write every queued row and stop the worker (call on application shutdown)"""
+        with self._worker_lock:
+            self._closed = True
+            worker = self._worker
+        
+        if worker is not None:
+            self._queue.put(self._STOP)
+            worker.join(timeout)
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    self._flush(batch)
+                    return
+                batch.append(item)
+            
+            self._flush(batch)
+    
+    def _flush(self, batch: list):
+        try:
+            result = _get_supabase().table(self.table).insert([row for row, _ in batch]).execute()
+            records = result.data or []
+        except APIError as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            
+            logger.warning(f"Batch insert of {len(batch)} {self.table} rows rejected, retrying row by row: {e}")
+            for item in batch:
+                self._flush([item])
+            return
+        except Exception as e:
+            # Outcome unknown (e.g. client timeout after the server committed) - fail without retrying
+            logger.warning(f"Batch insert of {len(batch)} {self.table} rows failed: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        
+        # PostgREST returns inserted rows in request order
+        for i, (_, future) in enumerate(batch):
+            future.set_result(records[i] if i < len(records) else None)
+
+
+_diagnosis_insert_batcher = DiagnosisInsertBatcher(
+    'gait_diagnosis', max_batch=DIAGNOSIS_INSERT_MAX_ROWS, max_wait_ms=DIAGNOSIS_INSERT_WAIT_MS
+)
+
+
+class LRUTTLCache:
+    """Thread-safe LRU cache whose entries also expire after ttl_seconds"""
+    
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            
+            self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key: str, value: Any):
+        if self.max_entries <= 0:
+            return
+        
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DiagnosisMemo(LRUTTLCache):
+    """
+    LRU + TTL memo of RAG diagnoses for repeated prompts
+    
+    Keys hash the model name together with the final composed prompt, so only a
+    request the LLM would see as identical skips retrieval and the LLM call.
+    """
+    
+    @staticmethod
+    def make_key(prompt_str: str, model_name: str = AI_MODEL_NAME) -> str:
+        payload = f"{model_name}\0{prompt_str}"
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+_diagnosis_memo = DiagnosisMemo(DIAGNOSIS_MEMO_MAX_ENTRIES if DIAGNOSIS_MEMO_ENABLED else 0, DIAGNOSIS_MEMO_TTL_SECONDS)
+
+# Query embeddings keyed by sha256 of the normalized prompt (process-wide)
+_query_embedding_cache = LRUTTLCache(EMBED_CACHE_MAX_ENTRIES, EMBED_CACHE_TTL_SECONDS)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_embeddings() -> HuggingFaceEmbeddings:
+    """Load the sentence embedding model once per process (int8 ONNX Runtime when configured)"""
+    encode_kwargs = {
+        'batch_size': EMBEDDING_BATCH_SIZE,
+        'normalize_embeddings': True,
+        'show_progress_bar': False
+    }
+    
+    if EMBEDDING_BACKEND == 'onnx':
+        try:
+            embeddings = HuggingFaceEmbeddings(
+                model_name=EMBEDDING_MODEL_NAME,
+                model_kwargs={
+                    'device': 'cpu',
+                    'backend': 'onnx',
+                    'model_kwargs': {'file_name': EMBEDDING_ONNX_FILE}
+                },
+                encode_kwargs=encode_kwargs
+            )
+            logger.info(f"✅ Using quantized ONNX embeddings: {EMBEDDING_ONNX_FILE}")
+            return embeddings
+        except Exception as e:
+            logger.warning(f"ONNX embedding backend unavailable, falling back to torch: {e}")
+    
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        model_kwargs={'device': EMBEDDING_DEVICE},
+        encode_kwargs=encode_kwargs
+    )
+
+
+def _load_pdf_pages(pdf_path: str, pdf_file: str) -> List[Document]:
+    """Load one PDF and tag its pages (runs on a loader thread)"""
+    pdf_docs = PyPDFLoader(pdf_path).load()
+    
+    for doc in pdf_docs:
+        doc.metadata.update({
+            "source_file": pdf_file,
+            "document_type": "medical_literature"
+        })
+    
+    return pdf_docs
+
 class ComposePromptNode(BaseNode):
     """
     Node 9: Compose diagnostic prompt from gait metrics
@@ -94,62 +547,12 @@ class ComposePromptNode(BaseNode):
             # Create concise, evidence-based diagnostic prompt
             # Focus only on objective metrics, avoid lengthy LLM generation
             
-            # Extract ALL 12 gait metrics with normal ranges for comparison
-            avg_stride_time = gait_metrics.get('avg_stride_time', 0)
-            avg_stride_length = gait_metrics.get('avg_stride_length', 0) 
-            avg_walking_speed = gait_metrics.get('avg_walking_speed', 0)
-            cadence = gait_metrics.get('cadence', 0)
-            stride_time_asymmetry = gait_metrics.get('stride_time_asymmetry', 0)
-            stride_length_asymmetry = gait_metrics.get('stride_length_asymmetry', 0)
-            stride_time_cv = gait_metrics.get('stride_time_cv', 0)
-            walking_speed_cv = gait_metrics.get('walking_speed_cv', 0)
-            
-            # Additional 4 metrics (previously missing from RAG prompt)
-            stride_length_cv = gait_metrics.get('stride_length_cv', 0)
-            step_width = gait_metrics.get('step_width', 0)
-            gait_regularity_index = gait_metrics.get('gait_regularity_index', 0)
-            gait_stability_ratio = gait_metrics.get('gait_stability_ratio', 0)
-            
-            # New phase ratio metrics
-            stance_phase_ratio = gait_metrics.get('stance_phase_ratio', 0.6)
-            swing_phase_ratio = gait_metrics.get('swing_phase_ratio', 0.4)
-            double_support_ratio = gait_metrics.get('double_support_ratio', 0.2)
+            # Take ALL 15 metrics from the gait metrics, falling back to the defaults
+            prompt_values = {**PROMPT_METRIC_DEFAULTS, "height_cm": height_cm, "date": date}
+            prompt_values.update((key, gait_metrics[key]) for key in PROMPT_METRIC_DEFAULTS.keys() & gait_metrics.keys())
             
             # Create comprehensive prompt with ALL 15 metrics
-            structured_prompt = f"""보행 분석 결과
-
-환자 정보: 신장 {height_cm}cm, 날짜 {date}
-
-전체 15개 객관적 지표:
-
-【시간적 지표】
-• 보폭 시간: {avg_stride_time:.2f}초 (정상: 1.0-1.3초)
-• 보행률: {cadence:.0f}걸음/분 (정상: 100-120)
-• 보폭 시간 변동성: {stride_time_cv:.1f}% (정상: <5%)
-
-【공간적 지표】
-• 보폭 길이: {avg_stride_length:.2f}m (정상: 1.2-1.6m)
-• 보폭 길이 변동성: {stride_length_cv:.1f}% (정상: <5%)
-• 보폭 폭: {step_width:.2f}m (정상: 0.1-0.15m)
-
-【속도 지표】
-• 보행 속도: {avg_walking_speed:.2f}m/s (정상: 1.0-1.4m/s)
-• 보행 속도 변동성: {walking_speed_cv:.1f}% (정상: <5%)
-
-【비대칭성 지표】
-• 보폭 시간 비대칭성: {stride_time_asymmetry:.1f}% (정상: <5%)
-• 보폭 길이 비대칭성: {stride_length_asymmetry:.1f}% (정상: <5%)
-
-【안정성 지표】
-• 보행 규칙성 지수: {gait_regularity_index:.3f} (정상: >0.8)
-• 보행 안정성 비율: {gait_stability_ratio:.3f} (정상: >0.8)
-
-【보행 주기 지표】
-• 입각기 비율: {stance_phase_ratio:.1%} (정상: 60-65%)
-• 유각기 비율: {swing_phase_ratio:.1%} (정상: 35-40%)
-• 양발지지 비율: {double_support_ratio:.1%} (정상: 15-25%)
-
-임상 질문: 이 15개 모든 지표를 종합적으로 분석하여 가장 가능성이 높은 임상 평가는 무엇입니까? 정상 대 병리학적 패턴만 고려하세요."""
+            structured_prompt = DIAGNOSTIC_PROMPT_TEMPLATE.format_map(prompt_values)
             
             # Update state
             state["prompt_str"] = structured_prompt
@@ -169,23 +572,62 @@ class RagDiagnosisNode(BaseNode):
     Retrieves relevant medical information and generates diagnosis
     """
     
+    # Embedding model and vector store shared by every instance in the process
+    _shared_embeddings = None
+    _shared_vector_store = None
+    _shared_lock = threading.Lock()
+    
     def __init__(self):
         super().__init__(PipelineStages.RAG_DIAGNOSIS)
         self.vector_store = None
         self.embeddings = None
-        self._initialize_rag_system()
+        self._pending_pdf_files = []  # new or previously failed PDFs to add to an existing collection
+        
+        # Load the model / ChromaDB / PDFs off the constructor; execute() waits on _ready
+        self._ready = threading.Event()
+        threading.Thread(target=self._initialize_in_background, name="rag-init", daemon=True).start()
+    
+    @property
+    def is_ready(self) -> bool:
+        """True once background initialization finished with a usable vector store"""
+        return self._ready.is_set() and self.vector_store is not None
+    
+    def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until background initialization finishes; False on timeout or failure"""
+        return self._ready.wait(timeout) and self.vector_store is not None
+    
+    def _initialize_in_background(self):
+        """Initialize RAG system, then signal readiness"""
+        try:
+            self._initialize_rag_system()
+        except Exception as e:
+            self.logger.error(f"Background RAG initialization failed: {e}")
+        finally:
+            self._ready.set()
     
     def _initialize_rag_system(self):
-        """Initialize the RAG system: vector store, embeddings, and retriever."""
+        """Initialize the RAG system once per process and reuse it across instances"""
+        with RagDiagnosisNode._shared_lock:
+            if RagDiagnosisNode._shared_vector_store is not None:
+                self.embeddings = RagDiagnosisNode._shared_embeddings
+                self.vector_store = RagDiagnosisNode._shared_vector_store
+                self.logger.info("♻️ 공유 RAG 시스템 재사용")
+                return
+            
+            self._build_rag_system()
+            
+            if self.vector_store is not None:
+                RagDiagnosisNode._shared_embeddings = self.embeddings
+                RagDiagnosisNode._shared_vector_store = self.vector_store
+    
+    def _build_rag_system(self):
+        """Build the RAG system: vector store, embeddings, and knowledge base"""
         max_retries = 3
         retry_count = 0
         
         while retry_count < max_retries:
             try:
-                self.embeddings = HuggingFaceEmbeddings(
-                    model_name="sentence-transformers/all-MiniLM-L6-v2",
-                    model_kwargs={'device': 'cpu'}
-                )
+                self.embeddings = _get_embeddings()
                 
                 # Define ChromaDB path relative to project root
                 project_root = Path(os.getenv('PROJECT_ROOT', '.'))
@@ -196,7 +638,8 @@ class RagDiagnosisNode(BaseNode):
                 
                 self.vector_store = Chroma(
                     embedding_function=self.embeddings,
-                    persist_directory=chroma_db_path
+                    persist_directory=chroma_db_path,
+                    collection_metadata=HNSW_COLLECTION_METADATA
                 )
                 
                 # 🚀 **최적화**: 기존 임베딩 데이터가 있는지 확인
@@ -205,10 +648,16 @@ class RagDiagnosisNode(BaseNode):
                 if existing_data_count > 0:
                     self.logger.info(f"✅ ChromaDB 기존 임베딩 데이터 발견: {existing_data_count}개 문서")
                     self.logger.info("⚡ PDF 재로딩 건너뛰기 - 기존 임베딩 사용")
+                    
+                    if self._pending_pdf_files:
+                        self.logger.info(f"📄 새로 추가되었거나 이전에 실패한 PDF {len(self._pending_pdf_files)}개만 추가 적재")
+                        self._load_medical_pdfs(Path("docs/medical_pdfs"), self._pending_pdf_files)
                 else:
                     self.logger.info("📚 새로운 임베딩 생성 필요 - PDF 로딩 시작")
                     self._load_medical_pdfs(Path("docs/medical_pdfs"))
                 
+                self._warm_vector_index()
+                
                 self.logger.info("✅ RAG system initialized successfully.")
                 return  # Success, exit retry loop
                 
@@ -221,7 +670,6 @@ class RagDiagnosisNode(BaseNode):
                     project_root = Path(os.getenv('PROJECT_ROOT', '.'))
                     chroma_db_path = str(project_root / "chroma_db")
                     try:
-                        import shutil
                         if Path(chroma_db_path).exists():
                             shutil.rmtree(chroma_db_path)
                             self.logger.info(f"Cleaned ChromaDB directory for retry {retry_count + 1}")
@@ -231,6 +679,15 @@ class RagDiagnosisNode(BaseNode):
                     self.logger.error(f"Failed to initialize RAG system after {max_retries} attempts: {e}")
                     self.vector_store = None
     
+    def _warm_vector_index(self):
+        """Run one 1-NN query so the HNSW index and embedder are loaded before the first request"""
+        try:
+            warmup_embedding = self.embeddings.embed_query(VECTOR_INDEX_WARMUP_QUERY)
+            self.vector_store.similarity_search_by_vector(warmup_embedding, k=1)
+            self.logger.info("🔥 HNSW 인덱스 워밍업 완료")
+        except Exception as e:
+            self.logger.warning(f"Vector index warm-up failed: {e}")
+    
     def _check_existing_embeddings(self) -> int:
         """
         ChromaDB에 기존 임베딩 데이터가 있는지 확인
@@ -238,6 +695,8 @@ class RagDiagnosisNode(BaseNode):
         Returns:
             int: 기존 문서의 개수 (0이면 새로 임베딩 필요)
         """
+        self._pending_pdf_files = []
+        
         try:
             # 환경변수로 강제 리로딩 옵션 제공
             force_reload = os.getenv('RAG_FORCE_RELOAD', 'false').lower() == 'true'
@@ -245,6 +704,12 @@ class RagDiagnosisNode(BaseNode):
                 self.logger.info("🔄 RAG_FORCE_RELOAD=true - 강제로 PDF 재로딩 수행")
                 return 0
             
+            # 마지막 적재 이후 PDF/인덱스 설정이 그대로면 ChromaDB 조회 생략
+            ingested_count = self._read_ingest_sentinel(Path("docs/medical_pdfs"))
+            if ingested_count > 0:
+                self.logger.info(f"⚡ 적재 기록 일치: {ingested_count}개 청크 - ChromaDB 확인 생략")
+                return ingested_count
+            
             # ChromaDB에서 기존 컬렉션의 문서 수를 확인
             collection = self.vector_store._collection
             
@@ -254,22 +719,33 @@ class RagDiagnosisNode(BaseNode):
             if document_count > 0:
                 self.logger.info(f"💾 기존 ChromaDB 데이터: {document_count}개 문서 발견")
                 
-                # PDF 파일 변경 감지 (선택적)
-                pdf_changed = self._check_pdf_files_changed()
-                if pdf_changed:
-                    self.logger.info("📄 PDF 파일 변경 감지 - 재임베딩 수행")
+                # HNSW 설정이 다른 기존 컬렉션은 재생성 (인덱스 설정은 생성 시에만 적용됨)
+                collection_metadata = collection.metadata or {}
+                if any(collection_metadata.get(k) != v for k, v in HNSW_COLLECTION_METADATA.items()):
+                    self.logger.info("🔧 HNSW 인덱스 설정 변경 감지 - 컬렉션 재생성 후 재임베딩")
+                    self.vector_store.reset_collection()
                     return 0
                 
-                # 샘플 문서 정보 로그 (디버깅용)
-                try:
-                    sample_results = collection.peek(limit=3)
-                    if sample_results and 'metadatas' in sample_results:
-                        for i, metadata in enumerate(sample_results['metadatas'][:3]):
-                            source_file = metadata.get('source_file', 'unknown')
-                            doc_type = metadata.get('document_type', 'unknown')
-                            self.logger.debug(f"   📄 샘플 {i+1}: {source_file} ({doc_type})")
-                except Exception as peek_error:
-                    self.logger.debug(f"샘플 문서 정보 조회 실패: {peek_error}")
+                # PDF 파일 변경 감지: 적재된 PDF가 수정/삭제된 경우에만 전체 재임베딩
+                reset_needed, self._pending_pdf_files = self._check_pdf_files_changed()
+                if reset_needed:
+                    # 수정/삭제된 PDF의 청크가 남지 않도록 컬렉션을 비운 뒤 재임베딩
+                    self.logger.info("📄 적재된 PDF 변경 감지 - 컬렉션 초기화 후 재임베딩 수행")
+                    self.vector_store.reset_collection()
+                    self._pending_pdf_files = []
+                    return 0
+                
+                # 샘플 문서 정보 로그 (디버깅용, DEBUG 레벨에서만 조회)
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    try:
+                        sample_results = collection.peek(limit=3)
+                        if sample_results and 'metadatas' in sample_results:
+                            for i, metadata in enumerate(sample_results['metadatas'][:3]):
+                                source_file = metadata.get('source_file', 'unknown')
+                                doc_type = metadata.get('document_type', 'unknown')
+                                self.logger.debug(f"   📄 샘플 {i+1}: {source_file} ({doc_type})")
+                    except Exception as peek_error:
+                        self.logger.debug(f"샘플 문서 정보 조회 실패: {peek_error}")
                 
                 return document_count
             else:
@@ -281,82 +757,200 @@ class RagDiagnosisNode(BaseNode):
             # 확인 실패 시 안전하게 새로 임베딩하도록 0 반환
             return 0
     
-    def _check_pdf_files_changed(self) -> bool:
+    def _check_pdf_files_changed(self) -> Tuple[bool, List[Path]]:
         """
-        PDF 파일이 변경되었는지 확인 (선택적 기능)
+        PDF 파일이 변경되었는지 확인
+        
+        마지막 임베딩 시 저장한 PDF 매니페스트(적재된 파일과 적재 실패 파일을 따로 기록)와 비교합니다.
+        적재된 PDF가 삭제되었거나, RAG_CHECK_PDF_CHANGES=true일 때 내용이 바뀐 경우에만 컬렉션 초기화가 필요하며,
+        새로 추가되었거나 이전에 적재에 실패한 PDF는 추가 적재 대상으로만 반환합니다.
         
         Returns:
-            bool: PDF 파일이 변경되었으면 True
+            Tuple[bool, List[Path]]: (컬렉션 초기화 필요 여부, 추가 적재할 PDF 목록)
         """
         try:
-            # 환경변수로 PDF 변경 감지 활성화 여부 확인
-            check_changes = os.getenv('RAG_CHECK_PDF_CHANGES', 'false').lower() == 'true'
-            if not check_changes:
-                return False
+            # 환경변수로 PDF 내용 변경 감지 활성화 여부 확인
+            check_contents = os.getenv('RAG_CHECK_PDF_CHANGES', 'false').lower() == 'true'
             
             docs_dir = Path("docs/medical_pdfs")
-            if not docs_dir.exists():
-                return False
-            
-            # PDF 파일들의 수정 시간 확인
-            pdf_files = list(docs_dir.glob("*.pdf"))
-            if not pdf_files:
-                return False
-            
-            # 가장 최근 PDF 수정 시간 찾기
-            latest_pdf_time = max(f.stat().st_mtime for f in pdf_files)
-            
-            # ChromaDB 생성 시간과 비교
-            project_root = Path(os.getenv('PROJECT_ROOT', '.'))
-            chroma_db_path = project_root / "chroma_db" / "chroma.sqlite3"
-            
-            if chroma_db_path.exists():
-                chroma_db_time = chroma_db_path.stat().st_mtime
-                
-                if latest_pdf_time > chroma_db_time:
-                    self.logger.info(f"📄 PDF 파일이 ChromaDB보다 최신: PDF={datetime.fromtimestamp(latest_pdf_time)}, DB={datetime.fromtimestamp(chroma_db_time)}")
-                    return True
-                else:
-                    self.logger.debug(f"📄 PDF 파일 변경 없음: PDF={datetime.fromtimestamp(latest_pdf_time)}, DB={datetime.fromtimestamp(chroma_db_time)}")
-                    return False
+            pdf_files = self._list_pdf_files(docs_dir) if docs_dir.exists() else []
+            
+            manifest = self._read_pdf_manifest()
+            if manifest is None:
+                # 매니페스트가 없으면 새로 생성 필요
+                if check_contents and pdf_files:
+                    self.logger.info("📄 PDF 매니페스트 없음 - 재임베딩 필요")
+                    return True, []
+                return False, []
+            
+            ingested, _failed = manifest
+            current_names = {f.name for f in pdf_files}
+            
+            removed = [name for name in ingested if name not in current_names]
+            if removed:
+                self.logger.info(f"📄 적재된 PDF 삭제 감지: {', '.join(removed)}")
+                return True, []
+            
+            if check_contents:
+                for pdf_path in pdf_files:
+                    if pdf_path.name in ingested and self._hash_pdf_file(pdf_path) != ingested[pdf_path.name]:
+                        self.logger.info(f"📄 PDF 내용 변경 감지: {pdf_path.name}")
+                        return True, []
+            
+            pending = [f for f in pdf_files if f.name not in ingested]
+            if pending and not ingested:
+                # 컬렉션에는 샘플 참고 자료만 있으므로 실제 PDF로 교체
+                self.logger.info("📄 샘플 참고 자료 대신 PDF 적재 - 재임베딩 필요")
+                return True, []
+            if pending:
+                self.logger.info(f"📄 추가 적재 대상 PDF (신규 또는 이전 적재 실패): {', '.join(f.name for f in pending)}")
             else:
-                # ChromaDB 파일이 없으면 새로 생성 필요
-                return True
+                self.logger.debug("📄 PDF 파일 변경 없음")
+            return False, pending
                 
         except Exception as e:
             self.logger.warning(f"PDF 파일 변경 감지 중 오류: {e}")
             # 오류 시 안전하게 변경 없음으로 처리
-            return False
+            return False, []
     
-    def _load_medical_pdfs(self, docs_dir: Path):
-        """Load medical PDFs, split them, and add to the vector store."""
+    @staticmethod
+    def _list_pdf_files(docs_dir: Path) -> List[Path]:
+        """PDFs in the knowledge directory in a stable order, skipping hidden/temp files"""
+        with os.scandir(docs_dir) as entries:
+            return sorted(
+                Path(entry.path) for entry in entries
+                if entry.name.endswith('.pdf')
+                and not entry.name.startswith(('.', '~'))
+                and entry.is_file()
+            )
+    
+    def _get_pdf_manifest_path(self) -> Path:
+        """Path of the manifest recording the PDF hashes of the last ingest"""
+        project_root = Path(os.getenv('PROJECT_ROOT', '.'))
+        return project_root / "chroma_db" / PDF_MANIFEST_FILENAME
+    
+    @staticmethod
+    def _hash_pdf_file(pdf_path: Path) -> str:
+        """Content hash of a PDF file, read in 1 MB blocks"""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(pdf_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def _read_pdf_manifest(self) -> Optional[Tuple[Dict[str, str], Dict[str, str]]]:
+        """(ingested, failed) name -> content hash maps of the last ingest, or None without a manifest"""
+        manifest_path = self._get_pdf_manifest_path()
+        if not manifest_path.exists():
+            return None
+        
+        manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+        if not isinstance(manifest.get("ingested"), dict):
+            return manifest, {}  # older manifests are a flat map of ingested files
+        return manifest["ingested"], manifest.get("failed", {})
+    
+    def _save_pdf_manifest(self, ingested_paths: List[Path], failed_paths: List[Path], keep_ingested: bool = False):
+        """Record content hashes of the ingested and the failed PDFs, optionally on top of the previous ingest"""
         try:
-            from langchain_community.document_loaders import PyPDFLoader
-            import os
+            previous = self._read_pdf_manifest() if keep_ingested else None
+            ingested = dict(previous[0]) if previous else {}
+            ingested.update({p.name: self._hash_pdf_file(p) for p in ingested_paths})
+            manifest = {
+                "ingested": ingested,
+                "failed": {p.name: self._hash_pdf_file(p) for p in failed_paths}
+            }
+            manifest_path = self._get_pdf_manifest_path()
+            manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            manifest_path.write_text(json.dumps(manifest, indent=2), encoding='utf-8')
+        except Exception as e:
+            self.logger.warning(f"Failed to write PDF manifest: {e}")
+    
+    def _get_ingest_sentinel_path(self) -> Path:
+        """Path of the sentinel recording the corpus of the last completed ingest"""
+        project_root = Path(os.getenv('PROJECT_ROOT', '.'))
+        return project_root / "chroma_db" / INGEST_SENTINEL_FILENAME
+    
+    @staticmethod
+    def _corpus_key(pdf_paths: List[Path]) -> str:
+        """Cheap fingerprint of the PDF corpus (name, size, mtime) and index settings"""
+        digest = hashlib.blake2b(digest_size=16)
+        for pdf_path in pdf_paths:
+            stat = pdf_path.stat()
+            digest.update(f"{pdf_path.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+        digest.update(json.dumps(HNSW_COLLECTION_METADATA, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _write_ingest_sentinel(self, docs_dir: Path, chunk_count: int):
+        """Record that the current corpus (including PDFs that failed to load) has been processed"""
+        try:
+            pdf_files = self._list_pdf_files(docs_dir) if docs_dir.exists() else []
+            sentinel = {"corpus_key": self._corpus_key(pdf_files), "count": chunk_count}
+            self._get_ingest_sentinel_path().write_text(json.dumps(sentinel), encoding='utf-8')
+        except Exception as e:
+            self.logger.warning(f"Failed to write ingest sentinel: {e}")
+    
+    def _read_ingest_sentinel(self, docs_dir: Path) -> int:
+        """
+        Chunk count of the last ingest if the corpus is unchanged since then
+        
+        Returns:
+            int: Ingested chunk count, or 0 when the sentinel is missing or stale
+        """
+        try:
+            sentinel_path = self._get_ingest_sentinel_path()
+            if not sentinel_path.exists():
+                return 0
             
+            sentinel = json.loads(sentinel_path.read_text(encoding='utf-8'))
+            pdf_files = self._list_pdf_files(docs_dir) if docs_dir.exists() else []
+            if sentinel.get("corpus_key") != self._corpus_key(pdf_files):
+                return 0
+            
+            return int(sentinel.get("count", 0))
+        except Exception as e:
+            self.logger.debug(f"Ingest sentinel unreadable: {e}")
+            return 0
+    
+    def _load_medical_pdfs(self, docs_dir: Path, pdf_files: Optional[List[Path]] = None):
+        """Load medical PDFs, split them, and add to the vector store (only pdf_files when given)."""
+        try:
             documents = []
+            loaded_files = []
+            incremental = pdf_files is not None
             
             if docs_dir.exists():
-                pdf_files = [f for f in os.listdir(docs_dir) if f.endswith('.pdf')]
+                if pdf_files is None:
+                    pdf_files = self._list_pdf_files(docs_dir)
                 
-                for pdf_file in pdf_files:
-                    try:
-                        pdf_path = docs_dir / pdf_file
-                        loader = PyPDFLoader(str(pdf_path))
-                        pdf_docs = loader.load()
-                        
-                        for doc in pdf_docs:
-                            doc.metadata.update({
-                                "source_file": pdf_file,
-                                "document_type": "medical_literature"
-                            })
-                        
-                        documents.extend(pdf_docs)
-                        self.logger.info(f"✅ Loaded PDF: {pdf_file} ({len(pdf_docs)} pages)")
+                # Load files on a small thread pool; worker processes would re-import
+                # fastapi_server (which builds every node at import time) in each child
+                if pdf_files:
+                    max_workers = min(8, os.cpu_count() or 1, len(pdf_files))
+                    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdf-load") as executor:
+                        futures = {
+                            pdf_path: executor.submit(_load_pdf_pages, str(pdf_path), pdf_path.name)
+                            for pdf_path in pdf_files
+                        }
                         
-                    except Exception as e:
-                        self.logger.warning(f"Failed to load PDF {pdf_file}: {str(e)}")
-                        continue
+                        for pdf_path, future in futures.items():
+                            try:
+                                pdf_docs = future.result()
+                                documents.extend(pdf_docs)
+                                loaded_files.append(pdf_path)
+                                self.logger.info(f"✅ Loaded PDF: {pdf_path.name} ({len(pdf_docs)} pages)")
+                                
+                            except Exception as e:
+                                self.logger.warning(f"Failed to load PDF {pdf_path.name}: {str(e)}")
+                                continue
+            
+            failed_files = [p for p in (pdf_files or []) if p not in loaded_files]
+            
+            if not documents and incremental:
+                # Keep the existing collection; just remember the failures so they are not retried until changed
+                self.logger.warning("No additional PDF files loaded - keeping the existing knowledge base")
+                self._save_pdf_manifest([], failed_files, keep_ingested=True)
+                self._write_ingest_sentinel(docs_dir, self.vector_store._collection.count())
+                return
             
             if not documents:
                 self.logger.warning("No PDF files loaded, using sample medical reference")
@@ -401,16 +995,54 @@ class RagDiagnosisNode(BaseNode):
                 
             self.logger.info(f"Medical knowledge base loaded: {len(documents)} documents")
             
-            # Split documents and add to vector store
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=1000,
-                chunk_overlap=200
+            # Split documents by token count (paragraph -> sentence -> word)
+            tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_NAME)
+            text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+                tokenizer,
+                chunk_size=CHUNK_SIZE_TOKENS,
+                chunk_overlap=CHUNK_OVERLAP_TOKENS,
+                separators=["\n\n", "\n", "。", ". ", " ", ""],
+                add_start_index=True  # lets _merge_small_chunks drop the overlap between neighbours
             )
             
             chunks = text_splitter.split_documents(documents)
-            self.vector_store.add_documents(chunks)
+            chunks = self._merge_small_chunks(chunks, tokenizer)
+            
+            # Deterministic ids make re-ingesting the same content an upsert
+            unique_chunks = {}
+            for chunk in chunks:
+                unique_chunks.setdefault(self._chunk_id(chunk), chunk)
+            chunk_ids = list(unique_chunks)
+            chunks = list(unique_chunks.values())
+            
+            # Embed each slice in one call and upsert it straight into the collection;
+            # the write of slice N overlaps with embedding slice N+1
+            collection = self.vector_store._collection
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix="chroma-ingest") as writer:
+                pending_write = None
+                for start in range(0, len(chunks), INGEST_BATCH_SIZE):
+                    batch = chunks[start:start + INGEST_BATCH_SIZE]
+                    texts = [chunk.page_content for chunk in batch]
+                    embeddings = self.embeddings.embed_documents(texts)
+                    
+                    if pending_write is not None:
+                        pending_write.result()
+                    pending_write = writer.submit(
+                        collection.upsert,
+                        ids=chunk_ids[start:start + INGEST_BATCH_SIZE],
+                        embeddings=embeddings,
+                        documents=texts,
+                        metadatas=[chunk.metadata for chunk in batch]
+                    )
+                
+                if pending_write is not None:
+                    pending_write.result()
             
             self.logger.info(f"Added {len(chunks)} chunks to vector store")
+            
+            # Failed PDFs are recorded separately and retried on their own once the corpus changes
+            self._save_pdf_manifest(loaded_files, failed_files, keep_ingested=incremental)
+            self._write_ingest_sentinel(docs_dir, collection.count())
                 
         except ImportError:
             self.logger.warning("PyPDFLoader not available, using sample medical data")
@@ -421,28 +1053,53 @@ class RagDiagnosisNode(BaseNode):
             # Just return the single doc, assuming no vector store to add to
             return [sample_doc]
     
-    def get_system_prompt(self) -> str:
-        return """You are a medical AI specialist in gait analysis and movement disorders.
-        
-        Your task is to provide evidence-based medical diagnosis using retrieved medical knowledge:
-        
-        Diagnostic process:
-        1. Analyze retrieved medical literature
-        2. Compare patient metrics with known pathological patterns
-        3. Generate differential diagnoses with confidence levels
-        4. Provide clinical recommendations
-        5. Suggest further evaluations if needed
+    @staticmethod
+    def _chunk_id(chunk: Document) -> str:
+        """Content-derived id for a chunk: source file, page and text"""
+        key = f"{chunk.metadata.get('source_file')}:{chunk.metadata.get('page')}:{chunk.page_content}"
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+    
+    def _merge_small_chunks(self, chunks: List[Document], tokenizer) -> List[Document]:
+        """Greedily merge adjacent undersized chunks from the same page, dropping their shared overlap"""
+        merged = []
+        merged_lengths = []
+        merged_ends = []  # end offset of each merged chunk in its page text (-1 if unknown)
         
-        Output requirements:
-        - Primary diagnosis with rationale
-        - Differential diagnoses (2-3 alternatives)
-        - Confidence level (0-100%)
-        - Clinical recommendations
-        - Rehabilitation suggestions
-        - Red flags or urgent referrals
+        for chunk in chunks:
+            start = chunk.metadata.pop("start_index", -1)
+            end = start + len(chunk.page_content) if start >= 0 else -1
+            
+            if merged and merged[-1].metadata == chunk.metadata:
+                previous = merged[-1]
+                previous_end = merged_ends[-1]
+                
+                # The splitter repeats up to CHUNK_OVERLAP_TOKENS of the previous chunk; keep only the new text
+                overlaps = 0 <= start < previous_end
+                content = chunk.page_content[previous_end - start:] if overlaps else chunk.page_content
+                length = len(tokenizer.encode(content, add_special_tokens=False))
+                
+                is_small = length < CHUNK_MERGE_MIN_TOKENS or merged_lengths[-1] < CHUNK_MERGE_MIN_TOKENS
+                fits = merged_lengths[-1] + length <= CHUNK_MERGE_MAX_TOKENS
+                
+                if is_small and fits:
+                    previous.page_content = previous.page_content + ("" if overlaps else "\n") + content
+                    merged_lengths[-1] += length
+                    merged_ends[-1] = max(previous_end, end)
+                    continue
+                
+                if overlaps:
+                    length = len(tokenizer.encode(chunk.page_content, add_special_tokens=False))
+            else:
+                length = len(tokenizer.encode(chunk.page_content, add_special_tokens=False))
+            
+            merged.append(chunk)
+            merged_lengths.append(length)
+            merged_ends.append(end)
         
-        Base all conclusions on evidence from retrieved medical sources.
-        """
+        return merged
+    
+    def get_system_prompt(self) -> str:
+        return RAG_DIAGNOSIS_SYSTEM_PROMPT
     
     def execute(self, state: GraphState) -> GraphState:
         """Generate RAG-based medical diagnosis"""
@@ -450,6 +1107,13 @@ class RagDiagnosisNode(BaseNode):
         if not self.validate_state_requirements(state, ["prompt_str"]):
             return StateManager.set_error(state, "Missing required field: prompt_str", "validation_error")
         
+        if not self._ready.is_set():
+            self.logger.info("⏳ Waiting for RAG system initialization")
+            if not self._ready.wait(RAG_INIT_TIMEOUT_SECONDS):
+                return StateManager.set_error(
+                    state, f"RAG system initialization timed out after {RAG_INIT_TIMEOUT_SECONDS:.0f}s", "rag_system_error"
+                )
+        
         if self.vector_store is None:
             return StateManager.set_error(state, "RAG system not initialized", "rag_system_error")
         
@@ -458,90 +1122,16 @@ class RagDiagnosisNode(BaseNode):
         gait_metrics = state.get("gait_metrics", {})
 
         try:
-            # Retrieve relevant medical knowledge
-            retriever = self.vector_store.as_retriever(search_kwargs={"k": 4})
-            relevant_docs = retriever.get_relevant_documents(prompt_str)
-            
-            # Format retrieved knowledge with source information
-            retrieved_knowledge = ""
-            source_info = []
-            
-            for i, doc in enumerate(relevant_docs, 1):
-                source_file = doc.metadata.get('source_file', 'unknown_source')
-                doc_type = doc.metadata.get('document_type', 'unknown_type')
-                page_num = doc.metadata.get('page', '알 수 없음')
-                
-                # Extract relevant content snippet
-                content_snippet = doc.page_content.strip()
-                if len(content_snippet) > 300:
-                    content_snippet = content_snippet[:300] + "..."
-                
-                retrieved_knowledge += f"""
-=== 참조문헌 {i}: {source_file} ===
-문서유형: {doc_type}
-페이지: {page_num}
-관련내용:
-{content_snippet}
-
-"""
-                
-                source_info.append({
-                    "번호": i,
-                    "파일명": source_file,
-                    "문서유형": doc_type,
-                    "페이지": page_num,
-                    "내용길이": len(doc.page_content)
-                })
+            # Reuse the diagnosis only for an identical composed prompt (opt-in via RAG_DIAGNOSIS_MEMO)
+            memo_key = DiagnosisMemo.make_key(prompt_str)
+            memoized = _diagnosis_memo.get(memo_key)
             
-            self.logger.info(f"Retrieved {len(relevant_docs)} documents for RAG diagnosis")
-            
-            # Create comprehensive diagnostic prompt with structured output request
-            diagnostic_llm_prompt = f"""
-            당신은 임상 보행 분석 전문의입니다. 아래 검색된 의료 문헌 정보를 바탕으로 환자를 진단하고 구조화된 평가를 제공하세요.
-            
-            === 검색된 의료 문헌 정보 ===
-            {retrieved_knowledge}
-            
-            === 환자 보행 분석 데이터 ===
-            {prompt_str}
-            
-            === 진단 지침 ===
-            1. **오직 검색된 의료 문헌의 기준과 정보만 사용**하여 진단하세요
-            2. 진단 근거를 제시할 때 **구체적인 문헌명과 내용을 인용**하세요
-            3. 각 판단마다 **"참조문헌 X에 따르면..."** 형식으로 출처를 명시하세요
-            4. 검색된 정보에 근거가 없으면 "추가 정보 필요"라고 명시하세요
-            5. 최종 평가는 정확한 점수(0-100)와 상태를 포함하세요
-            
-            === 응답 형식 (정확히 이 형식으로만 응답) ===
-            CLINICAL_ASSESSMENT: [정상/주의/위험 중 하나]
-            SCORE: [0-100 사이의 정수]
-            STATUS: [구체적인 상태 설명]
-            RISK_LEVEL: [정상 단계/주의 단계/위험 단계 중 하나]
-            
-            임상 평가: [검색된 문헌 기준으로 상세 판정]
-            
-            주요 소견: [검색된 문헌에서 찾은 관련 패턴과 환자 데이터 비교]
-            
-            문헌 근거: 
-            - 참조문헌 1 ({source_info[0]["파일명"] if source_info else "알 수 없음"}): [구체적 인용 내용]
-            - 참조문헌 2 ({source_info[1]["파일명"] if len(source_info) > 1 else "알 수 없음"}): [구체적 인용 내용]
-            - 참조문헌 3 ({source_info[2]["파일명"] if len(source_info) > 2 else "알 수 없음"}): [구체적 인용 내용]
-            - 참조문헌 4 ({source_info[3]["파일명"] if len(source_info) > 3 else "알 수 없음"}): [구체적 인용 내용]
-            
-            신뢰도: [검색된 정보의 충분성과 일치성에 따른 신뢰도]
-            
-            진단: [검색된 문헌에 기반한 가능성 높은 진단명]
-            
-            권장사항: [검색된 문헌에서 제시된 치료/관리 방안]
-            
-            참고문헌 목록:
-            {chr(10).join([f"- {info['파일명']} (페이지 {info['페이지']})" for info in source_info])}
-            
-            **중요: 응답 시작 부분의 CLINICAL_ASSESSMENT, SCORE, STATUS, RISK_LEVEL을 반드시 포함하고, 모든 판단은 검색된 의료 문헌 정보에만 근거하세요.**
-            """
-            
-            # Get LLM diagnosis
-            diagnosis_response = self.invoke_llm(diagnostic_llm_prompt)
+            if memoized is not None:
+                diagnosis_response, source_info = memoized
+                self.logger.info("⚡ Diagnosis memo hit - reusing RAG diagnosis for identical prompt")
+            else:
+                diagnosis_response, source_info = self._generate_rag_diagnosis(prompt_str)
+                _diagnosis_memo.put(memo_key, (diagnosis_response, source_info))
             
             # Generate structured JSON diagnosis result with RAG integration
             structured_diagnosis = self._generate_structured_diagnosis(state, gait_metrics, diagnosis_response, source_info)
@@ -555,14 +1145,14 @@ class RagDiagnosisNode(BaseNode):
                 "session_id": session_id,
                 "diagnosis_timestamp": datetime.now().isoformat(),
                 "raw_diagnosis": diagnosis_response,
-                "retrieved_sources": len(relevant_docs),
+                "retrieved_sources": len(source_info),
                 "knowledge_base_used": "medical_pdfs",
                 "prompt_length": len(prompt_str),
                 "response_length": len(diagnosis_response),
                 "source_documents": source_info
             }
             
-            self.logger.info(f"RAG diagnosis generated: {len(diagnosis_response)} characters from {len(relevant_docs)} sources")
+            self.logger.info(f"RAG diagnosis generated: {len(diagnosis_response)} characters from {len(source_info)} sources")
             
             return state
             
@@ -571,6 +1161,82 @@ class RagDiagnosisNode(BaseNode):
             self.logger.error(error_msg)
             return StateManager.set_error(state, error_msg, "rag_diagnosis_error")
     
+    def _embed_query(self, text: str) -> List[float]:
+        """Embed a retrieval query, reusing the vector of a previously seen prompt"""
+        key = hashlib.sha256(text.strip().lower().encode('utf-8')).hexdigest()
+        embedding = _query_embedding_cache.get(key)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(text)
+            _query_embedding_cache.put(key, embedding)
+        return embedding
+    
+    def _generate_rag_diagnosis(self, prompt_str: str) -> tuple:
+        """Retrieve medical knowledge and generate the LLM diagnosis
+        
+        Returns:
+            tuple: (diagnosis_response, source_info)
+        """
+        # Retrieve relevant medical knowledge (query embedding cached per prompt)
+        query_embedding = self._embed_query(prompt_str)
+        relevant_docs = self.vector_store.similarity_search_by_vector(query_embedding, k=RETRIEVAL_TOP_K)
+        
+        # Format retrieved knowledge with source information
+        retrieved_knowledge = self._format_retrieved_knowledge(relevant_docs)
+        source_info = self._extract_source_info(relevant_docs)
+        
+        self.logger.info(f"Retrieved {len(relevant_docs)} documents for RAG diagnosis")
+        
+        # Only per-request content goes in the user turn; the static instructions live in
+        # the system prompt so the provider can reuse the cached prompt prefix
+        reference_list = "\n".join(f"- {info['파일명']} (페이지 {info['페이지']})" for info in source_info)
+        diagnostic_llm_prompt = RAG_DIAGNOSIS_USER_TEMPLATE.format(
+            retrieved_knowledge=retrieved_knowledge,
+            patient_data=prompt_str,
+            reference_list=reference_list or "- 알 수 없음"
+        )
+        
+        # Get LLM diagnosis
+        diagnosis_response = self.invoke_llm(diagnostic_llm_prompt)
+        
+        return diagnosis_response, source_info
+    
+    def _format_retrieved_knowledge(self, docs: List[Document]) -> str:
+        """Format retrieved documents as numbered references for the LLM prompt"""
+        parts = []
+        
+        for i, doc in enumerate(docs, 1):
+            metadata = doc.metadata
+            
+            # Extract relevant content snippet (slice first; chunks are stored already stripped)
+            page_content = doc.page_content
+            content_snippet = page_content[:RETRIEVED_SNIPPET_LENGTH].strip()
+            if len(page_content) > RETRIEVED_SNIPPET_LENGTH:
+                content_snippet += "..."
+            
+            parts.append(RETRIEVED_DOCUMENT_TEMPLATE.format(
+                index=i,
+                source_file=metadata.get('source_file', 'unknown_source'),
+                doc_type=metadata.get('document_type', 'unknown_type'),
+                page_num=metadata.get('page', '알 수 없음'),
+                content=content_snippet
+            ))
+        
+        return "".join(parts)
+    
+    @staticmethod
+    def _extract_source_info(docs: List[Document]) -> List[Dict[str, Any]]:
+        """Summarize retrieved documents for the diagnosis metadata"""
+        return [
+            {
+                "번호": i,
+                "파일명": doc.metadata.get('source_file', 'unknown_source'),
+                "문서유형": doc.metadata.get('document_type', 'unknown_type'),
+                "페이지": doc.metadata.get('page', '알 수 없음'),
+                "내용길이": len(doc.page_content)
+            }
+            for i, doc in enumerate(docs, 1)
+        ]
+    
     def _generate_structured_diagnosis(self, state: GraphState, gait_metrics: dict, raw_diagnosis: str, source_info: list) -> dict:
         """Generate structured JSON diagnosis matching API endpoint format"""
         
@@ -584,9 +1250,10 @@ class RagDiagnosisNode(BaseNode):
             # Initial assessment calculation
             initial_score, initial_status, initial_risk_level = self._calculate_overall_assessment(gait_metrics, indicators)
             
-            # Parse structured RAG assessment from LLM response
+            # Parse structured RAG assessment from LLM response (single pass over the text)
+            assessment_fields = self._parse_assessment_fields(raw_diagnosis)
             final_score, final_status, final_risk_level = self._parse_structured_rag_assessment(
-                raw_diagnosis, initial_score, initial_status, initial_risk_level
+                assessment_fields, initial_score, initial_status, initial_risk_level
             )
             
             # Extract detailed report from raw diagnosis
@@ -622,10 +1289,7 @@ class RagDiagnosisNode(BaseNode):
                     "analyzedAt": datetime.now().isoformat(),
                     "indicators": [],
                     "diseases": [],
-                    "detailedReport": {
-                        "title": "진단 오류",
-                        "content": "분석 중 오류가 발생했습니다. 다시 시도해 주세요."
-                    }
+                    "detailedReport": dict(DETAILED_REPORT_GENERATION_ERROR)
                 }
             }
     
@@ -635,66 +1299,23 @@ class RagDiagnosisNode(BaseNode):
         indicators = []
         
         try:
-            # 1. Stride Time (보폭 시간)
-            stride_time = gait_metrics.get('avg_stride_time', 1.1)
-            stride_time_status, stride_time_result = self._assess_stride_time(stride_time)
-            indicators.append({
-                "id": "stride-time",
-                "name": "보폭 시간",
-                "value": f"{stride_time:.2f}초",
-                "status": stride_time_status,
-                "description": "한쪽 발이 땅에 닿은 후, 같은 발이 다시 닿을 때까지 걸리는 시간입니다. 걸음 템포를 확인할 수 있어요.",
-                "result": stride_time_result
-            })
-            
-            # 2. Double Support (양발 지지 비율) - 실제 계산된 값 사용
-            double_support_ratio = gait_metrics.get('double_support_ratio', 0.2) * 100  # Convert ratio to percentage
-            ds_status, ds_result = self._assess_double_support(double_support_ratio)
-            indicators.append({
-                "id": "double-support", 
-                "name": "양발 지지 비율",
-                "value": f"{double_support_ratio:.1f}%",
-                "status": ds_status,
-                "description": "두 발이 동시에 땅에 닿아 있는 시간의 비율이에요. 보행 균형이 불안할수록 높아집니다.",
-                "result": ds_result
-            })
-            
-            # 3. Stride Difference (양발 보폭 차이)
-            stride_asymmetry = gait_metrics.get('stride_length_asymmetry', 0.0)
-            stride_diff_m = self._convert_asymmetry_to_meters(stride_asymmetry, gait_metrics.get('avg_stride_length', 1.2))
-            asym_status, asym_result = self._assess_stride_asymmetry(stride_asymmetry)
-            indicators.append({
-                "id": "stride-difference",
-                "name": "양발 보폭 차이", 
-                "value": f"{stride_diff_m:.2f}m",
-                "status": asym_status,
-                "description": "왼발과 오른발의 걸음 길이가 얼마나 다른지를 보여줍니다. 좌우 균형 상태를 파악할 수 있어요.",
-                "result": asym_result
-            })
-            
-            # 4. Walking Speed (평균 보행 속도)
-            walking_speed = gait_metrics.get('avg_walking_speed', 1.2)
-            speed_status, speed_result = self._assess_walking_speed(walking_speed)
-            indicators.append({
-                "id": "walking-speed",
-                "name": "평균 보행 속도",
-                "value": f"{walking_speed:.1f}m/s", 
-                "status": speed_status,
-                "description": "단위 시간 동안 이동한 거리를 나타내는 지표입니다. 전체 활동성과 운동 능력을 확인할 수 있어요.",
-                "result": speed_result
-            })
-            
-            # 5. Stance Phase Ratio (입각기 비율)
-            stance_phase_ratio = gait_metrics.get('stance_phase_ratio', 0.6)
-            stance_status, stance_result = self._assess_stance_phase_ratio(stance_phase_ratio)
-            indicators.append({
-                "id": "stance-phase",
-                "name": "입각기 비율",
-                "value": f"{stance_phase_ratio:.1%}",
-                "status": stance_status,
-                "description": "보행 주기 중 발이 땅에 닿아 있는 시간의 비율입니다. 균형과 안정성을 평가할 수 있어요.",
-                "result": stance_result
-            })
+            for indicator_id, name, metric_key, default, scale, format_value, description, classify in INDICATOR_SPECS:
+                value = gait_metrics.get(metric_key, default) * scale
+                status = classify(value)
+                
+                # Asymmetry is assessed in percent but displayed as a stride length difference
+                display_value = value
+                if indicator_id == "stride-difference":
+                    display_value = self._convert_asymmetry_to_meters(value, gait_metrics.get('avg_stride_length', 1.2))
+                
+                indicators.append({
+                    "id": indicator_id,
+                    "name": name,
+                    "value": format_value(display_value),
+                    "status": status,
+                    "description": description,
+                    "result": INDICATOR_RESULTS[status]
+                })
             
         except Exception as e:
             self.logger.error(f"Error generating indicators: {str(e)}")
@@ -792,57 +1413,10 @@ class RagDiagnosisNode(BaseNode):
             return 50, "분석 오류", "확인 필요"
     
     # Helper methods for indicator assessments
-    def _assess_stride_time(self, stride_time: float) -> tuple:
-        """Assess stride time and return status and result"""
-        if 1.0 <= stride_time <= 1.2:
-            return "normal", "분석 결과 정상입니다!"
-        elif 0.8 <= stride_time < 1.0 or 1.2 < stride_time <= 1.4:
-            return "warning", "분석 결과 주의입니다!"
-        else:
-            return "danger", "분석 결과 위험입니다!"
-    
-
-    
-    def _assess_double_support(self, ratio: float) -> tuple:
-        """Assess double support ratio"""
-        if ratio < 25.0:
-            return "normal", "분석 결과 정상입니다!"
-        elif 25.0 <= ratio <= 30.0:
-            return "warning", "분석 결과 주의입니다!"
-        else:
-            return "danger", "분석 결과 위험입니다!"
-    
     def _convert_asymmetry_to_meters(self, asymmetry_percent: float, avg_stride_length: float) -> float:
         """Convert stride asymmetry percentage to meter difference"""
         return (asymmetry_percent / 100.0) * avg_stride_length
     
-    def _assess_stride_asymmetry(self, asymmetry: float) -> tuple:
-        """Assess stride length asymmetry"""
-        if asymmetry < 3.0:
-            return "normal", "분석 결과 정상입니다!"
-        elif 3.0 <= asymmetry <= 7.0:
-            return "warning", "분석 결과 주의입니다!"
-        else:
-            return "danger", "분석 결과 위험입니다!"
-    
-    def _assess_walking_speed(self, speed: float) -> tuple:
-        """Assess walking speed"""
-        if speed > 1.2:
-            return "normal", "분석 결과 정상입니다!"
-        elif 0.9 <= speed <= 1.2:
-            return "warning", "분석 결과 주의입니다!"
-        else:
-            return "danger", "분석 결과 위험입니다!"
-    
-    def _assess_stance_phase_ratio(self, ratio: float) -> tuple:
-        """Assess stance phase ratio"""
-        if 0.5 <= ratio <= 0.7:
-            return "normal", "분석 결과 정상입니다!"
-        elif 0.3 <= ratio < 0.5 or 0.7 < ratio <= 1.0:
-            return "warning", "분석 결과 주의입니다!"
-        else:
-            return "danger", "분석 결과 위험입니다!"
-    
     # Disease risk calculation methods
     def _calculate_parkinson_risk(self, gait_metrics: dict) -> float:
         """Calculate Parkinson's disease risk score"""
@@ -921,34 +1495,25 @@ class RagDiagnosisNode(BaseNode):
         
         return status, trend
     
-    def _parse_structured_rag_assessment(self, rag_response: str, initial_score: int, initial_status: str, initial_risk_level: str) -> tuple:
-        """Parse structured assessment from RAG LLM response"""
+    @staticmethod
+    def _parse_assessment_fields(rag_response: str) -> Dict[str, str]:
+        """Collect the structured LLM fields (CLINICAL_ASSESSMENT, SCORE, ...) into a dict"""
+        return {
+            match.group(1): match.group(2).strip()
+            for match in ASSESSMENT_FIELD_PATTERN.finditer(rag_response)
+        }
+    
+    def _parse_structured_rag_assessment(self, fields: Dict[str, str], initial_score: int, initial_status: str, initial_risk_level: str) -> tuple:
+        """Resolve score, status and risk level from the parsed RAG assessment fields"""
         
         try:
-            # Extract structured fields from LLM response
-            lines = rag_response.strip().split('\n')
-            
-            rag_score = None
-            rag_status = None
-            rag_risk_level = None
-            rag_assessment = None
-            
-            for line in lines:
-                line = line.strip()
-                if line.startswith('CLINICAL_ASSESSMENT:'):
-                    rag_assessment = line.split(':', 1)[1].strip()
-                elif line.startswith('SCORE:'):
-                    try:
-                        rag_score = int(line.split(':', 1)[1].strip())
-                    except (ValueError, IndexError):
-                        pass
-                elif line.startswith('STATUS:'):
-                    rag_status = line.split(':', 1)[1].strip()
-                elif line.startswith('RISK_LEVEL:'):
-                    rag_risk_level = line.split(':', 1)[1].strip()
+            score_match = SCORE_VALUE_PATTERN.match(fields.get('SCORE', ''))
+            rag_score = max(0, min(100, int(score_match.group(1)))) if score_match else None
+            rag_status = fields.get('STATUS')
+            rag_risk_level = fields.get('RISK_LEVEL')
             
             # Use RAG assessment if available and valid
-            if rag_score is not None and 0 <= rag_score <= 100:
+            if rag_score is not None:
                 final_score = rag_score
                 self.logger.info(f"Using RAG score: {rag_score} (initial was {initial_score})")
             else:
@@ -989,20 +1554,13 @@ class RagDiagnosisNode(BaseNode):
     def _extract_detailed_report(self, raw_diagnosis: str) -> dict:
         """Extract detailed report from raw diagnosis text"""
         try:
-            # Try to extract title and content from diagnosis
-            lines = raw_diagnosis.strip().split('\n')
-            
-            # Look for diagnosis or assessment line
-            title = "의료 진단 결과"
+            # Look for the first diagnosis or assessment line
+            title = DETAILED_REPORT_DEFAULT_TITLE
             content = raw_diagnosis
             
-            for line in lines:
-                if "진단:" in line:
-                    title = line.split(":")[-1].strip()
-                    break
-                elif "임상 평가:" in line:
-                    title = line.split(":")[-1].strip()
-                    break
+            title_match = REPORT_TITLE_LINE_PATTERN.search(raw_diagnosis)
+            if title_match:
+                title = title_match.group(0).split(":")[-1].strip()
             
             # Clean up content - allow full content instead of truncating
             # Remove the 500 character limit to show complete diagnosis
@@ -1016,10 +1574,7 @@ class RagDiagnosisNode(BaseNode):
             
         except Exception as e:
             self.logger.error(f"Error extracting detailed report: {str(e)}")
-            return {
-                "title": "진단 결과",
-                "content": "진단 결과를 처리하는 중 오류가 발생했습니다."
-            }
+            return dict(DETAILED_REPORT_EXTRACTION_ERROR)
 
 class StoreDiagnosisNode(BaseNode):
     """
@@ -1027,6 +1582,12 @@ class StoreDiagnosisNode(BaseNode):
     Saves RAG-generated diagnosis and recommendations
     """
     
+    # Confidence adjustment applied to the score per risk level
+    RISK_LEVEL_CONFIDENCE_ADJUSTMENTS = {
+        "정상 단계": 0.1,
+        "위험 단계": -0.2
+    }
+    
     def __init__(self):
         super().__init__(PipelineStages.STORE_DIAGNOSIS)
     
@@ -1062,18 +1623,6 @@ class StoreDiagnosisNode(BaseNode):
         session_id = state.get("session_id")
 
         try:
-            from supabase import create_client
-            import json
-            
-            # Use Service Role key to bypass RLS policies
-            supabase_url = os.getenv('SUPABASE_URL')
-            supabase_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
-            
-            if not supabase_url or not supabase_key:
-                raise ValueError("Supabase credentials not found in environment variables")
-                
-            supabase = create_client(supabase_url, supabase_key)
-            
             # Handle both old format (string) and new format (structured JSON)
             if isinstance(diagnosis_result, dict) and diagnosis_result.get("success") is not None:
                 # New structured JSON format
@@ -1081,6 +1630,7 @@ class StoreDiagnosisNode(BaseNode):
                 confidence_score = self._extract_confidence_score(diagnosis_result)
             else:
                 # Legacy text format - convert to structured format for compatibility
+                diagnosis_text = str(diagnosis_result)
                 diagnosis_content = {
                     "success": True,
                     "data": {
@@ -1093,18 +1643,18 @@ class StoreDiagnosisNode(BaseNode):
                         "diseases": [],
                         "detailedReport": {
                             "title": "Legacy 진단 결과",
-                            "content": str(diagnosis_result)[:500]
+                            "content": diagnosis_text[:500]
                         }
                     },
                     # Add legacy metadata for compatibility
                     "legacy_metadata": {
-                        'diagnosis_text': str(diagnosis_result),
+                        'diagnosis_text': diagnosis_text,
                         'diagnosis_timestamp': diagnosis_metadata.get('diagnosis_timestamp'),
                         'knowledge_base_used': diagnosis_metadata.get('knowledge_base_used'),
                         'prompt_length': diagnosis_metadata.get('prompt_length'),
                         'response_length': diagnosis_metadata.get('response_length'),
                         'diagnosis_method': 'RAG_PDF_BASED',
-                        'ai_model_used': os.getenv('OPENAI_MODEL', 'gpt-4o-mini'),
+                        'ai_model_used': AI_MODEL_NAME,
                         'confidence_level': 'AI_GENERATED'
                     }
                 }
@@ -1115,49 +1665,95 @@ class StoreDiagnosisNode(BaseNode):
                 'user_id': user_id,
                 'diagnosis_json': diagnosis_content,  # Store as JSONB directly
                 'retrieved_papers': diagnosis_metadata.get('retrieved_sources', 0),
-                'ai_model_used': os.getenv('OPENAI_MODEL', 'gpt-4o-mini'),
+                'ai_model_used': AI_MODEL_NAME,
                 'confidence_score': confidence_score,  # Numerical confidence score
                 'knowledge_base_version': 'medical_pdfs_v1',
                 'processing_time_seconds': None  # Could be extracted from metadata if available
             }
 
-            # Store to Supabase in 'gait_diagnosis' table
-            result = supabase.table('gait_diagnosis').insert(storage_data).execute()
+            # Store to Supabase in 'gait_diagnosis' table (batched with concurrent sessions)
+            pending_record = _diagnosis_insert_batcher.submit(storage_data)
+            
+            if DIAGNOSIS_INSERT_ASYNC:
+                # Write-behind: not stored yet; only the callback learns the outcome and record id
+                pending_record.add_done_callback(self._log_deferred_store)
+                state["diagnosis_stored"] = False
+                self.logger.info(f"Medical diagnosis queued for storage (pending): session {session_id}")
+                return state
+            
+            try:
+                stored_record = pending_record.result(timeout=DIAGNOSIS_INSERT_TIMEOUT_SECONDS)
+            except FutureTimeoutError:
+                return StateManager.set_error(
+                    state,
+                    f"Medical diagnosis storage timed out after {DIAGNOSIS_INSERT_TIMEOUT_SECONDS:.0f}s",
+                    "storage_error"
+                )
             
-            if result.data:
-                stored_record = result.data[0]
+            if stored_record:
                 record_id = stored_record.get('id')
                 state["diagnosis_record_id"] = record_id
                 state["diagnosis_stored"] = True
                 self.logger.info(f"Medical diagnosis stored successfully: Record ID {record_id}")
                 return state
             else:
-                error_info = getattr(result, 'error', 'Unknown error')
-                return StateManager.set_error(state, f"Failed to store medical diagnosis: {error_info}", "storage_error")
+                return StateManager.set_error(state, "Failed to store medical diagnosis: no record returned", "storage_error")
             
         except Exception as e:
             error_msg = f"Medical diagnosis storage failed: {str(e)}"
             self.logger.error(error_msg)
             return StateManager.set_error(state, error_msg, "storage_execution_error")
     
+    def _log_deferred_store(self, pending_record: Future):
+        """Report the outcome of a write-behind insert"""
+        error = pending_record.exception()
+        if error is not None:
+            self.logger.error(f"Deferred medical diagnosis storage failed: {error}")
+            return
+        
+        stored_record = pending_record.result()
+        if stored_record:
+            self.logger.info(f"Medical diagnosis stored successfully: Record ID {stored_record.get('id')}")
+        else:
+            self.logger.error("Deferred medical diagnosis storage returned no record")
+    
+    def close(self):
+        """Flush diagnosis rows still queued in the insert batcher (application shutdown)"""
+        _diagnosis_insert_batcher.close()
+    
+    def bulk_store(self, rows: List[Dict[str, Any]], chunk_size: int = BULK_INSERT_CHUNK_SIZE) -> List[Dict[str, Any]]:
+        """
+        Insert many gait_diagnosis rows for backfills and replays
+        
+        Rows are sent as PostgREST array inserts of chunk_size rows each, so
+        Postgres sees one multi-row INSERT per chunk instead of one per row.
+        Not used on the online path, where DiagnosisInsertBatcher coalesces rows.
+        
+        Returns:
+            list: Inserted records in input order
+        """
+        supabase = _get_supabase()
+        stored_records = []
+        
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            result = supabase.table('gait_diagnosis').insert(chunk).execute()
+            stored_records.extend(result.data or [])
+            self.logger.info(f"Bulk stored {start + len(chunk)}/{len(rows)} diagnosis rows")
+        
+        return stored_records
+    
     def _extract_confidence_score(self, diagnosis_result: dict) -> float:
         """Extract numerical confidence score from structured diagnosis"""
         try:
             if diagnosis_result.get("success") and "data" in diagnosis_result:
                 data = diagnosis_result["data"]
                 
-                # Use the overall score as confidence (convert 0-100 to 0-1)
+                # Overall score as confidence (0-100 -> 0-1), adjusted by risk level
                 score = data.get("score", 50)
-                confidence = score / 100.0
-                
-                # Adjust based on risk level
-                risk_level = data.get("riskLevel", "확인 필요")
-                if risk_level == "정상 단계":
-                    confidence = min(1.0, confidence + 0.1)
-                elif risk_level == "위험 단계":
-                    confidence = max(0.0, confidence - 0.2)
+                adjustment = self.RISK_LEVEL_CONFIDENCE_ADJUSTMENTS.get(data.get("riskLevel"), 0.0)
                 
-                return round(min(1.0, max(0.0, confidence)), 3)
+                return round(min(1.0, max(0.0, score / 100.0 + adjustment)), 3)
             else:
                 return 0.5  # Default confidence for failed analysis
                 
@@ -2,21 +2,176 @@
 Response formatting nodes for LangGraph-based gait analysis pipeline
 Contains FormatResponseNode for final output formatting and cleanup
 """
+import re
 import json
+import bisect
+import operator
+import logging
 import shutil
 from pathlib import Path
+from types import MappingProxyType
 from datetime import datetime
 from typing import Dict, Any, Optional
 
 import os
 from dotenv import load_dotenv
 
-from .base_node import BaseNode
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .base_node import BaseNode, resolve_session_temp_dir
 from .graph_state import GraphState, StateManager, PipelineStages
 
 # Load environment variables
 load_dotenv()
 
+# Outermost {...} span of an LLM reply
+JSON_OBJECT_PATTERN = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def _json_loads(text) -> Any:
+    """Parse JSON with orjson when installed (its decode error subclasses json.JSONDecodeError)"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+# Error response used when the LLM reply has no JSON object; None slots are filled per call
+FALLBACK_ERROR_RESPONSE = MappingProxyType({
+    "status": "error",
+    "error_type": None,
+    "message": "An error occurred during gait analysis processing",
+    "details": None,
+    "session_id": None,
+    "next_steps": (
+        "Please try again with the same data",
+        "Contact support if the issue persists",
+        "Ensure input data meets system requirements"
+    ),
+    "timestamp": None
+})
+
+
+def _cleanup_session_temp_files(session_id: str, logger: logging.Logger) -> Dict[str, Any]:
+    """Delete this session's temporary files and summarize the outcome"""
+    cleanup_summary = {
+        "files_deleted": 0,
+        "files_failed": 0,
+        "deleted_files": [],
+        "failed_files": []
+    }
+    
+    # Nodes write into TEMP_DIR/<session_id> (BaseNode.get_session_temp_dir)
+    session_dir = resolve_session_temp_dir(session_id)
+    if session_dir is None or not session_dir.is_dir():
+        return cleanup_summary
+    
+    # Count every file first (subdirectories included), then remove the whole tree in one pass
+    session_files = [
+        os.path.join(root, name)
+        for root, _dirs, names in os.walk(session_dir)
+        for name in names
+    ]
+    errors = {}
+    
+    def _record_failure(function, path, exc_info):
+        errors[path] = exc_info[1]
+        logger.warning(f"Failed to delete {os.path.relpath(path, session_dir)}: {exc_info[1]}")
+    
+    shutil.rmtree(session_dir, onerror=_record_failure)
+    
+    for path in session_files:
+        name = os.path.relpath(path, session_dir)
+        if not os.path.lexists(path):
+            cleanup_summary["files_deleted"] += 1
+            cleanup_summary["deleted_files"].append(name)
+            logger.debug(f"Deleted temp file: {name}")
+        else:
+            # The file itself, or its directory listing, could not be removed
+            cleanup_summary["files_failed"] += 1
+            cleanup_summary["failed_files"].append({
+                "file": name,
+                "error": str(errors.get(path, "not removed"))
+            })
+    
+    logger.info(f"Cleanup complete: {cleanup_summary['files_deleted']} files deleted, {cleanup_summary['files_failed']} failed")
+    
+    return cleanup_summary
+
+
+# (id, name, metric key, default, value formatter, description, status rule) for legacy diagnoses
+FALLBACK_INDICATOR_SPECS = (
+    ("stride-time", "보행 주기", "avg_stride_time", 1.0, "{:.2f}초".format,
+     "한 발의 접촉부터 다음 같은 발의 접촉까지의 시간",
+     lambda v: "정상" if 0.9 <= v <= 1.3 else "주의" if 0.7 <= v < 1.5 else "위험"),
+    ("double-support", "양발 지지기", "avg_double_support_time", 0.2, "{:.2f}초".format,
+     "양발이 모두 지면에 접촉하는 시간",
+     lambda v: "정상" if v <= 0.25 else "주의" if v <= 0.35 else "위험"),
+    ("stride-difference", "보폭 차이", "stride_length_asymmetry", 0, "{:.1f}%".format,
+     "좌우 보폭의 비대칭성",
+     lambda v: "정상" if v < 5 else "주의" if v < 10 else "위험"),
+    ("walking-speed", "보행 속도", "avg_walking_speed", 1.0, "{:.2f}m/s".format,
+     "평균 보행 속도",
+     lambda v: "정상" if v >= 1.0 else "주의" if v >= 0.8 else "위험"),
+)
+
+# Fixed recommendations attached to every legacy-format response
+FALLBACK_RECOMMENDATIONS = (
+    "의료진과 상담하여 정확한 진단을 받으시기 바랍니다.",
+    "정기적인 보행 모니터링을 권장합니다.",
+    "운동 치료나 재활 프로그램을 고려해보세요.",
+)
+
+# (disease, base probability, probability when mentioned, keyword pattern) for legacy diagnoses
+DISEASE_KEYWORD_RULES = (
+    ("파킨슨병", 30, 65, re.compile(r"파킨슨|parkinson", re.IGNORECASE)),
+    ("뇌졸중", 25, 60, re.compile(r"뇌졸중|stroke", re.IGNORECASE)),
+)
+
+# (metric key, comparison, threshold, finding template) checked for the fallback key findings
+KEY_FINDING_RULES = (
+    ("avg_walking_speed", operator.lt, 1.0, "Reduced walking speed: {:.2f} m/s"),
+    ("avg_stride_length", operator.lt, 1.2, "Shortened stride length: {:.2f} m"),
+    ("stride_length_asymmetry", operator.gt, 5.0, "Gait asymmetry detected: {:.1f}%"),
+    ("stride_time_variability", operator.gt, 10.0, "Increased gait variability: {:.1f}%"),
+)
+
+# Indicator id -> category used in enhanced responses
+INDICATOR_CATEGORIES = {
+    "stride-time": "temporal",
+    "double-support": "temporal",
+    "stride-difference": "spatial",
+    "walking-speed": "kinematic"
+}
+
+# Indicator status -> points toward the fallback overall score
+STATUS_SCORES = {
+    "정상": 100,
+    "주의": 70,
+    "위험": 40
+}
+
+# Score band cut-offs (ascending) and the labels for each band: <60, 60-79, >=80
+SCORE_BAND_THRESHOLDS = (60, 80)
+SCORE_BAND_STATUSES = ("위험", "주의 필요", "정상")
+SCORE_BAND_RISK_LEVELS = ("위험 단계", "주의 단계", "정상 단계")
+
+# Stride-count cut-offs for data quality: <10, 10-19, >=20
+DATA_QUALITY_THRESHOLDS = (10, 20)
+DATA_QUALITY_LEVELS = ("Low", "Medium", "High")
+
+# Indicator statuses counted as risk factors in the response summary
+RISK_STATUSES = frozenset({"주의", "위험"})
+
+# Indicator status -> review priority
+STATUS_PRIORITIES = {
+    "정상": "low",
+    "주의": "medium",
+    "위험": "high"
+}
+
 class FormatResponseNode(BaseNode):
     """
     Node 12: Format final response JSON and cleanup temporary files
@@ -56,7 +211,11 @@ class FormatResponseNode(BaseNode):
         session_id = state["session_id"]
         date = state.get("date")
         height_cm = state.get("height_cm")
-        processing_time = state.get("processing_time", 0)
+        processing_time = state.get("processing_time") or 0
+        start_time = state.get("start_time")
+        if not processing_time and isinstance(start_time, datetime):
+            processing_time = (datetime.now() - start_time).total_seconds()
+            state["processing_time"] = processing_time
         
         try:
             # Check if diagnosis is already in structured format
@@ -67,9 +226,12 @@ class FormatResponseNode(BaseNode):
                 # Legacy format - convert to structured format
                 response_json = self._create_fallback_response(state)
             
+            # Cleanup temporary files (its counts also report how many files were processed)
+            cleanup_summary = _cleanup_session_temp_files(session_id, self.logger)
+            
             # Add technical metadata
-            response_json["metadata"] = response_json.get("metadata", {})
-            response_json["metadata"].update({
+            metadata = response_json.setdefault("metadata", {})
+            metadata.update({
                 "session_id": session_id,
                 "processing_timestamp": datetime.now().isoformat(),
                 "processing_time_seconds": round(processing_time, 2),
@@ -79,21 +241,18 @@ class FormatResponseNode(BaseNode):
                 "system_info": {
                     "analysis_date": date,
                     "patient_height_cm": height_cm,
-                    "temp_files_processed": self._count_temp_files(session_id),
+                    "temp_files_processed": cleanup_summary["files_deleted"] + cleanup_summary["files_failed"],
                     "metrics_record_id": state.get("metrics_record_id"),
                     "diagnosis_record_id": state.get("diagnosis_record_id")
-                }
+                },
+                "cleanup_summary": cleanup_summary
             })
             
-            # Cleanup temporary files
-            cleanup_summary = self._cleanup_temp_files(session_id)
-            response_json["metadata"]["cleanup_summary"] = cleanup_summary
-            
             # Update state with final response
             state["response"] = response_json
             state["final_response"] = response_json  # Alternative key for compatibility
             
-            self.logger.info(f"Response formatted successfully: {len(json.dumps(response_json))} characters")
+            self.logger.info(f"Response formatted successfully for session {session_id}")
             
             return state
             
@@ -105,12 +264,14 @@ class FormatResponseNode(BaseNode):
     def _enhance_structured_response(self, diagnosis_result: dict, state: GraphState) -> dict:
         """Enhance the structured diagnosis response with additional metadata"""
         
-        # Make a copy to avoid modifying the original
-        enhanced_response = json.loads(json.dumps(diagnosis_result))
+        # Copy only the containers mutated below; nested report/disease data is shared read-only
+        enhanced_response = dict(diagnosis_result)
+        if isinstance(enhanced_response.get("metadata"), dict):
+            enhanced_response["metadata"] = dict(enhanced_response["metadata"])
         
         # Add additional metadata to the response
         if "data" in enhanced_response:
-            data = enhanced_response["data"]
+            data = enhanced_response["data"] = dict(enhanced_response["data"])
             
             # Add session and processing info
             data["sessionId"] = state["session_id"]
@@ -124,17 +285,28 @@ class FormatResponseNode(BaseNode):
                 "data_quality": self._assess_data_quality(gait_metrics)
             }
             
-            # Enhance indicators with additional context
+            # Enhance indicators with additional context and count statuses in the same pass
+            risk_factors_count = normal_indicators_count = 0
             if "indicators" in data:
+                enhanced_indicators = []
                 for indicator in data["indicators"]:
-                    indicator["category"] = self._get_indicator_category(indicator["id"])
-                    indicator["priority"] = self._get_indicator_priority(indicator["status"])
+                    status = indicator["status"]
+                    enhanced_indicators.append({
+                        **indicator,
+                        "category": self._get_indicator_category(indicator["id"]),
+                        "priority": self._get_indicator_priority(status)
+                    })
+                    if status in RISK_STATUSES:
+                        risk_factors_count += 1
+                    elif status == "정상":
+                        normal_indicators_count += 1
+                data["indicators"] = enhanced_indicators
             
             # Add summary statistics
             data["summary"] = {
                 "overall_assessment": data.get("status", "Unknown"),
-                "risk_factors_count": self._count_risk_factors(data.get("indicators", [])),
-                "normal_indicators_count": self._count_normal_indicators(data.get("indicators", [])),
+                "risk_factors_count": risk_factors_count,
+                "normal_indicators_count": normal_indicators_count,
                 "recommendation_level": self._get_recommendation_level(data.get("riskLevel", "확인 필요"))
             }
         
@@ -167,11 +339,7 @@ class FormatResponseNode(BaseNode):
                 "detailedReport": {
                     "summary": f"전체적인 보행 분석 결과는 {status}입니다.",
                     "keyFindings": self._extract_key_findings(gait_metrics),
-                    "recommendations": [
-                        "의료진과 상담하여 정확한 진단을 받으시기 바랍니다.",
-                        "정기적인 보행 모니터링을 권장합니다.",
-                        "운동 치료나 재활 프로그램을 고려해보세요."
-                    ],
+                    "recommendations": list(FALLBACK_RECOMMENDATIONS),
                     "technicalDetails": {
                         "rawDiagnosis": diagnosis_text,
                         "sourcesReferenced": diagnosis_metadata.get("retrieved_sources", 0),
@@ -184,139 +352,58 @@ class FormatResponseNode(BaseNode):
     def _convert_metrics_to_indicators(self, gait_metrics: dict) -> list:
         """Convert gait metrics to structured indicators format"""
         indicators = []
-        
-        # Stride time indicator
-        avg_stride_time = gait_metrics.get("avg_stride_time", 1.0)
-        stride_time_status = "정상" if 0.9 <= avg_stride_time <= 1.3 else "주의" if 0.7 <= avg_stride_time < 1.5 else "위험"
-        indicators.append({
-            "id": "stride-time",
-            "name": "보행 주기",
-            "value": f"{avg_stride_time:.2f}초",
-            "status": stride_time_status,
-            "description": "한 발의 접촉부터 다음 같은 발의 접촉까지의 시간"
-        })
-        
-        # Double support indicator  
-        double_support_time = gait_metrics.get("avg_double_support_time", 0.2)
-        double_support_status = "정상" if double_support_time <= 0.25 else "주의" if double_support_time <= 0.35 else "위험"
-        indicators.append({
-            "id": "double-support",
-            "name": "양발 지지기",
-            "value": f"{double_support_time:.2f}초",
-            "status": double_support_status,
-            "description": "양발이 모두 지면에 접촉하는 시간"
-        })
-        
-        # Stride difference indicator
-        stride_asymmetry = gait_metrics.get("stride_length_asymmetry", 0)
-        stride_diff_status = "정상" if stride_asymmetry < 5 else "주의" if stride_asymmetry < 10 else "위험"
-        indicators.append({
-            "id": "stride-difference", 
-            "name": "보폭 차이",
-            "value": f"{stride_asymmetry:.1f}%",
-            "status": stride_diff_status,
-            "description": "좌우 보폭의 비대칭성"
-        })
-        
-        # Walking speed indicator
-        walking_speed = gait_metrics.get("avg_walking_speed", 1.0)
-        speed_status = "정상" if walking_speed >= 1.0 else "주의" if walking_speed >= 0.8 else "위험"
-        indicators.append({
-            "id": "walking-speed",
-            "name": "보행 속도", 
-            "value": f"{walking_speed:.2f}m/s",
-            "status": speed_status,
-            "description": "평균 보행 속도"
-        })
-        
+        for indicator_id, name, metric_key, default, format_value, description, classify in FALLBACK_INDICATOR_SPECS:
+            value = gait_metrics.get(metric_key, default)
+            indicators.append({
+                "id": indicator_id,
+                "name": name,
+                "value": format_value(value),
+                "status": classify(value),
+                "description": description
+            })
         return indicators
     
     def _extract_diseases_from_text(self, diagnosis_text: str) -> list:
         """Extract disease probabilities from text diagnosis"""
-        diseases = [
-            {"name": "파킨슨병", "probability": 30},
-            {"name": "뇌졸중", "probability": 25}
+        # Simple keyword-based probability adjustment
+        return [
+            {
+                "name": name,
+                "probability": mentioned_probability if diagnosis_text and pattern.search(diagnosis_text) else base_probability
+            }
+            for name, base_probability, mentioned_probability, pattern in DISEASE_KEYWORD_RULES
         ]
-        
-        if diagnosis_text:
-            text_lower = diagnosis_text.lower()
-            # Simple keyword-based probability adjustment
-            if "파킨슨" in text_lower or "parkinson" in text_lower:
-                diseases[0]["probability"] = 65
-            if "뇌졸중" in text_lower or "stroke" in text_lower:
-                diseases[1]["probability"] = 60
-                
-        return diseases
     
     def _calculate_fallback_score(self, indicators: list) -> int:
         """Calculate overall score from indicators"""
-        normal_count = sum(1 for ind in indicators if ind["status"] == "정상")
-        warning_count = sum(1 for ind in indicators if ind["status"] == "주의") 
-        danger_count = sum(1 for ind in indicators if ind["status"] == "위험")
-        
-        # Score calculation: normal=100, warning=70, danger=40
+        # Score calculation: normal=100, warning=70, danger=40 (single pass)
         total_indicators = len(indicators)
         if total_indicators == 0:
             return 50
             
-        score = (normal_count * 100 + warning_count * 70 + danger_count * 40) / total_indicators
+        score = sum(STATUS_SCORES.get(ind["status"], 0) for ind in indicators) / total_indicators
         return int(score)
     
     def _get_status_from_score(self, score: int) -> str:
         """Get status from score"""
-        if score >= 80:
-            return "정상"
-        elif score >= 60:
-            return "주의 필요"
-        else:
-            return "위험"
+        return SCORE_BAND_STATUSES[bisect.bisect_right(SCORE_BAND_THRESHOLDS, score)]
     
     def _get_risk_level_from_score(self, score: int) -> str:
         """Get risk level from score"""
-        if score >= 80:
-            return "정상 단계"
-        elif score >= 60:
-            return "주의 단계"
-        else:
-            return "위험 단계"
+        return SCORE_BAND_RISK_LEVELS[bisect.bisect_right(SCORE_BAND_THRESHOLDS, score)]
     
     def _assess_data_quality(self, gait_metrics: dict) -> str:
         """Assess the quality of gait data"""
         total_strides = gait_metrics.get("total_strides", 0)
-        
-        if total_strides >= 20:
-            return "High"
-        elif total_strides >= 10:
-            return "Medium"
-        else:
-            return "Low"
+        return DATA_QUALITY_LEVELS[bisect.bisect_right(DATA_QUALITY_THRESHOLDS, total_strides)]
     
     def _get_indicator_category(self, indicator_id: str) -> str:
         """Get category for indicator"""
-        categories = {
-            "stride-time": "temporal",
-            "double-support": "temporal", 
-            "stride-difference": "spatial",
-            "walking-speed": "kinematic"
-        }
-        return categories.get(indicator_id, "general")
+        return INDICATOR_CATEGORIES.get(indicator_id, "general")
     
     def _get_indicator_priority(self, status: str) -> str:
         """Get priority level for indicator status"""
-        priorities = {
-            "정상": "low",
-            "주의": "medium",
-            "위험": "high"
-        }
-        return priorities.get(status, "medium")
-    
-    def _count_risk_factors(self, indicators: list) -> int:
-        """Count indicators with warning or danger status"""
-        return sum(1 for ind in indicators if ind.get("status") in ["주의", "위험"])
-    
-    def _count_normal_indicators(self, indicators: list) -> int:
-        """Count indicators with normal status"""
-        return sum(1 for ind in indicators if ind.get("status") == "정상")
+        return STATUS_PRIORITIES.get(status, "medium")
     
     def _get_recommendation_level(self, risk_level: str) -> str:
         """Get recommendation level based on risk level"""
@@ -330,75 +417,12 @@ class FormatResponseNode(BaseNode):
     def _extract_key_findings(self, gait_metrics: Dict[str, Any]) -> list:
         """Extract key findings from gait metrics"""
         findings = []
-        
-        # Check walking speed
-        speed = gait_metrics.get("avg_walking_speed")
-        if speed and speed < 1.0:
-            findings.append(f"Reduced walking speed: {speed:.2f} m/s")
-        
-        # Check stride length
-        stride_length = gait_metrics.get("avg_stride_length")
-        if stride_length and stride_length < 1.2:
-            findings.append(f"Shortened stride length: {stride_length:.2f} m")
-        
-        # Check asymmetry
-        asymmetry = gait_metrics.get("stride_length_asymmetry")
-        if asymmetry and asymmetry > 5.0:
-            findings.append(f"Gait asymmetry detected: {asymmetry:.1f}%")
-        
-        # Check variability
-        variability = gait_metrics.get("stride_time_variability")
-        if variability and variability > 10.0:
-            findings.append(f"Increased gait variability: {variability:.1f}%")
+        for metric_key, compare, threshold, template in KEY_FINDING_RULES:
+            value = gait_metrics.get(metric_key)
+            if value and compare(value, threshold):
+                findings.append(template.format(value))
         
         return findings if findings else ["Normal gait parameters within expected ranges"]
-    
-    def _count_temp_files(self, session_id: str) -> int:
-        """Count temporary files for this session"""
-        temp_dir = Path(os.getenv('TEMP_DIR', './temp_files'))
-        if not temp_dir.exists():
-            return 0
-        
-        # Count files containing session ID
-        count = 0
-        for file_path in temp_dir.glob("*"):
-            if file_path.is_file() and session_id in file_path.name:
-                count += 1
-        
-        return count
-    
-    def _cleanup_temp_files(self, session_id: str) -> Dict[str, Any]:
-        """Clean up temporary files for this session"""
-        temp_dir = Path(os.getenv('TEMP_DIR', './temp_files'))
-        cleanup_summary = {
-            "files_deleted": 0,
-            "files_failed": 0,
-            "deleted_files": [],
-            "failed_files": []
-        }
-        
-        if not temp_dir.exists():
-            return cleanup_summary
-        
-        # Find and delete files containing session ID
-        for file_path in temp_dir.glob("*"):
-            if file_path.is_file() and session_id in file_path.name:
-                try:
-                    file_path.unlink()
-                    cleanup_summary["files_deleted"] += 1
-                    cleanup_summary["deleted_files"].append(file_path.name)
-                    self.logger.debug(f"Deleted temp file: {file_path.name}")
-                except Exception as e:
-                    cleanup_summary["files_failed"] += 1
-                    cleanup_summary["failed_files"].append({
-                        "file": file_path.name,
-                        "error": str(e)
-                    })
-                    self.logger.warning(f"Failed to delete {file_path.name}: {e}")
-        
-        self.logger.info(f"Cleanup complete: {cleanup_summary['files_deleted']} files deleted, {cleanup_summary['files_failed']} failed")
-        
-        return cleanup_summary
 
 
 class ErrorHandlerNode(BaseNode):
@@ -455,27 +479,26 @@ class ErrorHandlerNode(BaseNode):
         try:
             error_response = self.invoke_llm(llm_prompt)
             
-            # Try to parse as JSON
+            # Parse the outermost JSON object, ignoring ```json fences or surrounding prose
+            json_match = JSON_OBJECT_PATTERN.search(error_response)
             try:
-                response_json = json.loads(error_response)
+                response_json = _json_loads(json_match.group(0)) if json_match else None
             except json.JSONDecodeError:
+                response_json = None
+            
+            if not isinstance(response_json, dict):
                 # Fallback error response
-                response_json = {
-                    "status": "error",
-                    "error_type": error_type,
-                    "message": "An error occurred during gait analysis processing",
-                    "details": error_message,
-                    "session_id": session_id,
-                    "next_steps": [
-                        "Please try again with the same data",
-                        "Contact support if the issue persists",
-                        "Ensure input data meets system requirements"
-                    ],
-                    "timestamp": datetime.now().isoformat()
-                }
+                response_json = dict(
+                    FALLBACK_ERROR_RESPONSE,
+                    error_type=error_type,
+                    details=error_message,
+                    session_id=session_id,
+                    next_steps=list(FALLBACK_ERROR_RESPONSE["next_steps"]),
+                    timestamp=datetime.now().isoformat()
+                )
             
             # Cleanup temp files even in error case
-            cleanup_summary = self._cleanup_temp_files(session_id)
+            cleanup_summary = _cleanup_session_temp_files(session_id, self.logger)
             response_json["cleanup_summary"] = cleanup_summary
             
             state["response"] = response_json
@@ -496,24 +519,6 @@ class ErrorHandlerNode(BaseNode):
             
             self.logger.error(f"Critical error in error handler: {e}")
             return state
-    
-    def _cleanup_temp_files(self, session_id: str) -> Dict[str, Any]:
-        """Clean up temporary files (same as FormatResponseNode)"""
-        temp_dir = Path(os.getenv('TEMP_DIR', './temp_files'))
-        cleanup_summary = {"files_deleted": 0, "files_failed": 0}
-        
-        if not temp_dir.exists():
-            return cleanup_summary
-        
-        for file_path in temp_dir.glob("*"):
-            if file_path.is_file() and session_id in file_path.name:
-                try:
-                    file_path.unlink()
-                    cleanup_summary["files_deleted"] += 1
-                except Exception:
-                    cleanup_summary["files_failed"] += 1
-        
-        return cleanup_summary
 
 
 class NoDataHandlerNode(BaseNode):